@@ -14,12 +14,16 @@ import sys
 import threading
 import time
 
+import apocrypha.serialize as serialize
 from apocrypha.exceptions import DatabaseError
-from apocrypha.network import read, write
+from apocrypha.network import configure, encode, read, write, write_many
 
 HOST = 'localhost'
 PORT = 9999
 
+# replies query_many leaves unread before sending more
+QUERY_WINDOW = 64
+
 
 class Client():
     '''
@@ -42,6 +46,20 @@ class Client():
         except Exception:
             pass
 
+    def close(self):
+        ''' none -> none
+
+        close the connection to the server, the next query opens a new one
+        '''
+        with self.lock:
+            if self.sock:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock.close()
+                self.sock = None
+
     def query(self, keys, interpret=False):
         ''' list of str, maybe bool -> str | none
 
@@ -57,6 +75,52 @@ class Client():
 
         return result
 
+    def query_raw(self, message):
+        ''' bytes -> str
+
+        send an already encoded query and return the reply without splitting
+        it into lines. error replies are returned rather than raised
+        '''
+
+        with self.lock:
+            result, self.sock = _query_raw(
+                message, self.host, port=self.port, close=False,
+                sock=self.sock)
+
+        return result
+
+    def query_many(self, queries, window=QUERY_WINDOW):
+        ''' list of list of str, maybe int -> list of str
+
+        send many queries over the same connection without waiting for each
+        reply before sending the next. at most `window` queries are sent ahead
+        of their replies, which keeps typical queries and replies within the
+        socket buffers. the window is counted in messages rather than bytes,
+        so a window's worth of large values or replies can still fill the
+        buffers and stall both sides, use a smaller window for those. the
+        replies are returned in order, without being split into lines. error
+        replies are returned rather than raised
+
+        >>> db.query_many([['a', '--set', '"b"'], ['a']])
+        ['', 'b\\n']
+        '''
+
+        with self.lock:
+            try:
+                result, self.sock = _query_many_raw(
+                    [encode(args) for args in queries], self.host,
+                    port=self.port, sock=self.sock, window=window)
+
+            # the connection is closed or out of step with the server, the
+            # next query opens a new one
+            except (DatabaseError, OSError):
+                if self.sock:
+                    self.sock.close()
+                self.sock = None
+                raise
+
+        return result
+
     def get(self, *keys, default=None, cast=None):
         ''' str ..., maybe any, maybe any -> any | DatabaseError
 
@@ -184,7 +248,7 @@ class Client():
         keys = list(keys) if keys else ['']
 
         try:
-            value = json.dumps(value)
+            value = serialize.dumps(value).decode('utf-8')
             self.query(keys + ['--set', value])
 
         except (TypeError, ValueError):
@@ -221,20 +285,37 @@ def _query(args, host='localhost', port=9999, interpret=False,
     the real query function, all the others are wrappers
 
     send a query to an Apocrypha server, either returning a list of strs or
-    the result of json.loads() on the result
+    the parsed JSON result
     '''
 
     args = list(args)
-    remote = (host, port)
 
     if interpret and args and args[-1] not in {'-e', '--edit'}:
         args += ['--edit']
-    message = '\n'.join(args) + '\n'
 
-    # if they didn't give us a socket create a new one
+    result, sock = _query_raw(
+        encode(args), host=host, port=port, close=close, sock=sock)
+
+    result = list(filter(None, result.split('\n')))
+    if result and result[0].startswith('error: '):
+        raise DatabaseError(result[0]) from None
+
+    if interpret:
+        result = serialize.loads(''.join(result)) if result else None
+
+    return result, sock
+
+
+def _query_raw(message, host='localhost', port=9999, close=True, sock=None):
+    ''' bytes, str, int, bool, socket -> str, socket
+
+    send an encoded message and read back the reply, creating a socket if we
+    weren't given one
+    '''
     if not sock:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(remote)
+        sock.connect((host, port))
+        configure(sock)
 
     # send the message, get the reply using apocrypha.network calls
     write(sock, message)
@@ -247,14 +328,46 @@ def _query(args, host='localhost', port=9999, interpret=False,
     if close:
         sock.close()
 
-    result = list(filter(None, result.split('\n')))
-    if result and result[0].startswith('error: '):
-        raise DatabaseError(result[0]) from None
+    return result, sock
 
-    if interpret:
-        result = json.loads(''.join(result)) if result else None
 
-    return result, sock
+def _query_many_raw(messages, host='localhost', port=9999, sock=None,
+                    window=QUERY_WINDOW):
+    ''' list of bytes, str, int, socket, int -> list of str, socket
+
+    pipelined version of _query_raw, the socket is always left open
+    '''
+    if not sock:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((host, port))
+        except OSError:
+            sock.close()
+            raise
+        configure(sock)
+
+    results = []
+    sent = 0
+
+    while len(results) < len(messages):
+
+        # keep up to window messages in flight, topping up in one send once
+        # half of them have been answered
+        if sent < len(messages) and sent - len(results) <= window // 2:
+            end = min(len(messages), len(results) + window)
+            if write_many(sock, messages[sent:end]):
+                sock.close()
+                raise DatabaseError('error: network write')
+            sent = end
+
+        result, error = read(sock)
+        if error:
+            sock.close()
+            raise DatabaseError('error: network length')
+
+        results.append(result)
+
+    return results, sock
 
 
 def _edit_temp_file(temp_file):  # pragma: no cover
@@ -4,12 +4,16 @@
 # pylint: disable=too-many-branches
 # pylint: disable=too-many-return-statements
 # pylint: disable=too-many-instance-attributes
+# pylint: disable=useless-import-alias
 
 '''
 Database and exception definitions
 '''
 
-import json
+import bisect
+import collections
+import mmap
+import os
 import pprint
 import sys
 import threading
@@ -17,12 +21,11 @@ import time
 import zlib
 
 try:
-    from typing import List, Any, Union
-    from typing import Dict     # noqa: F401 pylint: disable=unused-import
-    from typing import Tuple    # noqa: F401 pylint: disable=unused-import
+    from typing import List, Any, Callable, Dict, Optional, Set, Tuple, Union  # noqa
 except ImportError:
     pass
 
+import apocrypha.serialize as serialize
 from apocrypha.exceptions import DatabaseError
 
 
@@ -31,10 +34,119 @@ OPERATORS = {
     '--set', '-d', '--del', '-p', '--pop'}
 
 READ_OPS = {
-    '-e', '--edit', '-k', '--keys'}
+    '@', '-e', '--edit', '-k', '--keys'}
 
 WRITE_OPS = OPERATORS - READ_OPS
 
+# most query results are a line or two, this keeps the cache to a few MB
+CACHE_SIZE = 4096
+
+# seconds the writer waits after being woken, so a burst of writes is saved
+# to disk once
+WRITE_DELAY = 0.2
+
+
+class LRUCache(collections.OrderedDict):
+    '''
+    query cache that forgets the least recently used result once it's full
+
+    results are indexed by the top level key they were read from, so a write
+    only needs to drop the results under the key it changed. queries that
+    don't start with a key, like `--keys` on the whole database, depend on
+    everything and are dropped by every write
+
+    get, set and clear hold the cache's own lock, so cache hits can be served
+    without holding the database lock
+    '''
+
+    def __init__(self, max_size: int = CACHE_SIZE) -> None:
+        collections.OrderedDict.__init__(self)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.index = {}     # type: Dict[Any, Set[Tuple]]
+
+    def __getitem__(self, key: Tuple) -> Any:
+        value = collections.OrderedDict.__getitem__(self, key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key: Tuple, default: Any = None) -> Any:
+        with self.lock:
+            if key not in self:
+                return default
+            return self[key]
+
+    def __setitem__(self, key: Tuple, value: Any) -> None:
+        with self.lock:
+            collections.OrderedDict.__setitem__(self, key, value)
+            self.move_to_end(key)
+            self.index.setdefault(root_key(key), set()).add(key)
+
+            if len(self) > self.max_size:
+                oldest, _ = self.popitem(last=False)
+                root = root_key(oldest)
+                bucket = self.index[root]
+                bucket.discard(oldest)
+
+                # an empty bucket would be left behind for every top level
+                # key ever cached
+                if not bucket:
+                    del self.index[root]
+
+    def clear(self) -> None:
+        with self.lock:
+            collections.OrderedDict.clear(self)
+            self.index.clear()
+
+    def invalidate(self, root: str) -> None:
+        '''
+        drop the results that depend on this top level key
+        '''
+        with self.lock:
+            for bucket in (root, None):
+                for key in self.index.pop(bucket, ()):
+                    collections.OrderedDict.pop(self, key, None)
+
+
+def root_key(key: Union[List[str], Tuple]) -> Any:
+    '''
+    the top level key a query depends on, None when it may depend on any of
+    them
+    '''
+    if not key or key[0] in OPERATORS or '@' in key:
+        return None
+
+    return key[0]
+
+
+def _equal(old: Any, new: Any) -> bool:
+    '''
+    whether an assignment would leave the value unchanged. values of different
+    types are never equal, so 1 and true are different and a mismatch is found
+    without walking either tree
+    '''
+    return type(old) is type(new) and (old is new or old == new)
+
+
+def _load(path: str) -> Any:
+    '''
+    read a database from disk, which may be compressed. the file is mapped
+    rather than read so it's parsed or decompressed straight from the page
+    cache
+    '''
+    with open(path, 'rb') as filep:
+        if not os.fstat(filep.fileno()).st_size:
+            raise ValueError('empty database')
+
+        with mmap.mmap(filep.fileno(), 0, access=mmap.ACCESS_READ) as raw_data:
+            try:
+                return serialize.loads(zlib.decompress(raw_data))
+            except zlib.error:
+                pass
+
+            with memoryview(raw_data) as view:
+                return serialize.loads(view)
+
 
 class Database():
     '''
@@ -46,14 +158,19 @@ class Database():
     '''
 
     def __init__(self, path: str, stateless: bool = False,
-                 headless: bool = True) -> None:
+                 headless: bool = True, cache_size: int = CACHE_SIZE,
+                 initial_data: Optional[dict] = None) -> None:
         '''
         @path           full path to the database json file
         @stateless      never write out changes to disk
         @headless       don't write to stdout, save in self.output
+        @cache_size     most query results to keep in the cache
+        @initial_data   already loaded data to use instead of reading path,
+                        the database takes ownership of it
         '''
         self.add_context = False
         self.dereference_occurred = False
+        self.placeholder_created = False
         self.write_needed = False
         self.headless = headless
         self.path = path
@@ -61,24 +178,37 @@ class Database():
         self.lock = threading.Lock()
 
         self.output = []    # type: List[str]
-        self.cache = {}     # type: Dict[Tuple, List[str]]
+        self.root = None    # type: Any
+
+        # _action looks up operators here rather than testing for each one
+        self._operators = {
+            '=': self._op_assign,
+            '+': self._op_append,
+            '-': self._op_remove,
+            '@': self._op_search,
+            '-k': self._op_keys, '--keys': self._op_keys,
+            '-e': self._op_edit, '--edit': self._op_edit,
+            '-s': self._op_set, '--set': self._op_set,
+            '-d': self._op_del, '--del': self._op_del,
+            '-p': self._op_pop, '--pop': self._op_pop,
+        }   # type: Dict[str, Callable[[Any, dict, List[str], int], None]]
+        self.cache = LRUCache(cache_size)
 
         self._queue_write = False
+        self._write_event = threading.Event()
 
-        try:
-            with open(path, 'rb') as filep:
-                raw_data = filep.read()
-                try:
-                    data = zlib.decompress(raw_data).decode()
-                    self.data = json.loads(data)
-                except zlib.error:
-                    self.data = json.loads(raw_data.decode())
+        if initial_data is not None:
+            self.data = initial_data
 
-        except FileNotFoundError:
-            self.data = {}
+        else:
+            try:
+                self.data = _load(path)
 
-        except ValueError:
-            self._error('could not parse database on disk')
+            except FileNotFoundError:
+                self.data = {}
+
+            except ValueError:
+                self._error('could not parse database on disk')
 
         self.writer_running = threading.Event()
         self.writer_running.set()
@@ -89,55 +219,120 @@ class Database():
     def post_action(self) -> None:
         '''
         cache, normalize, queue a disk write, reset internal values
+
+        reads only change the tree when they create placeholders, otherwise
+        there's nothing to normalize
         '''
-        self._normalize(self.data)
+        if self.write_needed or self.placeholder_created:
+            self._normalize(self.data)
 
         if self.write_needed:
-            self.cache = {}
+            self._invalidate()
             self._queue_write = True
+            self._write_event.set()
+
+        self.reset()
 
-        # reset
+    def reset(self) -> None:
+        '''
+        reset the internal values set up for a query. post_action does this,
+        queries that never touched self.data may do this alone
+        '''
         self.add_context = False
         self.dereference_occurred = False
         self.output = []
+        self.placeholder_created = False
+        self.root = None
         self.strict = False
         self.write_needed = False
 
-    def action(self, args: List[str]) -> None:
+    def action(self, args: List[str]) -> bool:
         '''
         may be overridden for custom behavior such as utilizing self.cache or
+
+        returns True when the query ran against self.data, meaning
+        post_action() is needed
         '''
+        self.root = root_key(args)
         self._action(self.data, args)
+        return True
+
+    def _invalidate(self) -> None:
+        '''
+        drop the cached results this query's write may have changed. writes
+        through references or to the whole database could change anything
+        '''
+        if self.root is None or self.dereference_occurred:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(self.root)
 
-    def _maybe_cache(self, args: List[str]) -> None:
+    def _maybe_cache(self, args: List[str],
+                     key: Optional[Tuple] = None) -> None:
         '''
-        check if we can cache the input and output of this query
+        check if we can cache the input and output of this query, callers that
+        already built the cache key may pass it in
         '''
-        key = tuple(args)
+        if key is None:
+            key = tuple(args)
 
         # do not cache if context was added, a dereference was required to
-        # get the result or the query contained a write operator
-        cache = not (self.add_context or self.dereference_occurred)
-        cache = cache and not WRITE_OPS.intersection(set(args))
+        # get the result or the query contained a write operator. searches
+        # always add context, so their results are the same either way. they
+        # depend on the whole database, so any write drops them
+        context = self.add_context and '@' not in key
+        cache = not (context or self.dereference_occurred)
+        cache = cache and WRITE_OPS.isdisjoint(args)
 
         if cache:
             self.cache[key] = self.output
 
-    def _writer(self) -> None:  # pragma: no cover
+    def stop_writer(self) -> None:
         '''
-        callback for writer_thread
+        stop the writer thread, it saves any changes it hasn't written yet
+        before exiting
         '''
-        while self.writer_running.is_set():
-            time.sleep(1)
+        self.writer_running.clear()
+        self._write_event.set()
 
-            if self._queue_write:
+        if self._writer_thread.is_alive():
+            self._writer_thread.join()
+
+    def _writer(self) -> None:
+        '''
+        callback for writer_thread, sleeps until post_action queues a write
+        '''
+        running = True
 
-                # write the updated values back out
-                with open(self.path, 'wb') as filep:
-                    data = json.dumps(self.data, separators=(',', ':'))
-                    filep.write(zlib.compress(data.encode()))
+        while running:
+            self._write_event.wait()
+            if self.writer_running.is_set():
+                time.sleep(WRITE_DELAY)
 
+            # stop_writer clears writer_running before waking us, so checking
+            # after the event is cleared can't miss it
+            self._write_event.clear()
+            running = self.writer_running.is_set()
+
+            if self._queue_write:
                 self._queue_write = False
+                self._write()
+
+    def _write(self) -> None:
+        '''
+        write the database back out. the snapshot is taken under the lock so
+        queries can't change it part way through, then it's written to a
+        temporary file and moved into place so the file on disk is always
+        complete
+        '''
+        with self.lock:
+            data = serialize.dumps(self.data)
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as filep:
+            filep.write(zlib.compress(data))
+
+        os.replace(temp_path, self.path)
 
     def _normalize(self, data: dict) -> bool:
         '''
@@ -210,67 +405,31 @@ class Database():
         last_base = {}  # type: Any
 
         for i, key in enumerate(keys):
-            left = keys[i - 1]      # type: str
-            right = keys[i + 1:]    # type: List[str]
-
-            if key in OPERATORS:
-                if key == '=':
-                    self._assign(last_base, left, right)
-                    return
-
-                if key == '+':
-                    self._append(last_base, left, right)
-                    return
-
-                if key == '-':
-                    self._remove(last_base, left, right)
-                    return
-
-                if key == '@':
-                    self._search(self.data, keys[i + 1], keys[:i])
-                    return
-
-                if key in {'-k', '--keys'}:
-                    self._keys(base, left)
-                    return
-
-                if key in {'-e', '--edit'}:
-                    self.output = [json.dumps(base, indent=4, sort_keys=True)]
-                    return
-
-                if key in {'-s', '--set'}:
-                    self._set(last_base, left, right[0])
-                    return
 
-                if key in {'-d', '--del'}:
-                    del last_base[left]
-                    self.write_needed = True
-                    return
-
-                if key in {'-p', '--pop'}:
-                    self._pop(last_base, left)
-                    return
+            operator = self._operators.get(key)
+            if operator:
+                operator(base, last_base, keys, i)
+                return
 
             # indexing
 
             # keep track of the level before so we can modify this level
             last_base = base
 
-            try:
-                key_is_reference = False
-                base_is_reference = False
+            key_is_reference = False
+            base_is_reference = False
 
+            # checked without indexing into dicts, which would raise for
+            # every level we pass through
+            if key:
                 if key[0] == '!':
                     key = key[1:]
                     key_is_reference = True
 
-                if base[0] == '!':
+                if not isinstance(base, dict) and base and base[0] == '!':
                     base = base[1:]
                     base_is_reference = True
 
-            except (IndexError, KeyError):
-                pass
-
             try:
                 if base_is_reference:
                     # we're rebasing ourselves on the dereferenced value of
@@ -285,7 +444,7 @@ class Database():
 
                 if key_is_reference:
                     # this means we're trying to get the value of a reference
-                    self._dereference(base, right)
+                    self._dereference(base, keys[i + 1:])
                     return
 
             except KeyError:
@@ -295,12 +454,13 @@ class Database():
                 # create a new key, if unused, it'll be cleaned by normalize()
                 base[key] = {}
                 base = base[key]
+                self.placeholder_created = True
 
             except TypeError:
                 self._error(
                     'cannot index through non-dict.'
                     ' {a} -> {b} -> ?, {a} :: {t}'
-                    .format(a=left, b=key, t=type(base).__name__))
+                    .format(a=keys[i - 1], b=key, t=type(base).__name__))
 
         self._display(base, context=' = '.join(keys[:-1]))
 
@@ -388,6 +548,46 @@ class Database():
 
         self.output += result
 
+    # operators, called by _action with the current level, the level above
+    # it, the query and the operator's position in the query
+
+    def _op_assign(self, _base: Any, last_base: dict,
+                   keys: List[str], i: int) -> None:
+        self._assign(last_base, keys[i - 1], keys[i + 1:])
+
+    def _op_append(self, _base: Any, last_base: dict,
+                   keys: List[str], i: int) -> None:
+        self._append(last_base, keys[i - 1], keys[i + 1:])
+
+    def _op_remove(self, _base: Any, last_base: dict,
+                   keys: List[str], i: int) -> None:
+        self._remove(last_base, keys[i - 1], keys[i + 1:])
+
+    def _op_search(self, _base: Any, _last_base: dict,
+                   keys: List[str], i: int) -> None:
+        self._search(self.data, keys[i + 1], keys[:i])
+
+    def _op_keys(self, base: Any, _last_base: dict,
+                 keys: List[str], i: int) -> None:
+        self._keys(base, keys[i - 1])
+
+    def _op_edit(self, base: Any, _last_base: dict,
+                 _keys: List[str], _i: int) -> None:
+        self.output = [serialize.dumps_pretty(base)]
+
+    def _op_set(self, _base: Any, last_base: dict,
+                keys: List[str], i: int) -> None:
+        self._set(last_base, keys[i - 1], keys[i + 1])
+
+    def _op_del(self, _base: Any, last_base: dict,
+                keys: List[str], i: int) -> None:
+        del last_base[keys[i - 1]]
+        self.write_needed = True
+
+    def _op_pop(self, _base: Any, last_base: dict,
+                keys: List[str], i: int) -> None:
+        self._pop(last_base, keys[i - 1])
+
     def _search(self, base: Union[dict, list], target: str,
                 context: List[str]) -> None:
         '''
@@ -425,7 +625,7 @@ class Database():
         # single = string, multi = list
         right = right[0] if len(right) == 1 else right
 
-        if base[left] == right:
+        if _equal(base[left], right):
             return
 
         base[left] = right
@@ -465,7 +665,16 @@ class Database():
                 'cannot retrieve keys non-dict. {a} :: {t}'
                 .format(a=left, t=type(base).__name__))
 
-        self._display(sorted(base.keys()))
+        keys = sorted(base)
+
+        # keys are added to the output as they are, unless one of them is a
+        # reference; _display follows those. they'd sort together after any
+        # key less than '!'
+        first = bisect.bisect_left(keys, '!')
+        if first < len(keys) and keys[first][:1] == '!':
+            self._display(keys)
+        else:
+            self.output += keys
 
     def _set(self, base: dict, left: str, right: str) -> None:
         '''
@@ -476,13 +685,13 @@ class Database():
         set the entire sub tree for this value with JSON
         '''
         try:
-            right = json.loads(right)
+            right = serialize.loads(right)
 
         except ValueError:
             self._error('malformed json')
 
         if base:
-            if base[left] == right:
+            if _equal(base[left], right):
                 return
             base[left] = right
         else:
@@ -506,6 +715,10 @@ class Database():
         if left not in base:
             self._error('{a} not in top level.'.format(a=left))
 
+        # items are removed one at a time, so an error part way through still
+        # leaves changes behind
+        self.write_needed = True
+
         # list
         if isinstance(base[left], list):
             for item in right:
@@ -533,8 +746,6 @@ class Database():
 
                 del base[left]
 
-        self.write_needed = True
-
     def _pop(self, base: dict, left: str) -> None:
         '''
         display the result then remove it atomically
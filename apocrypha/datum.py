@@ -7,24 +7,34 @@
 Experimental client that hides database calls
 '''
 
-import collections
+import collections.abc
 
 from apocrypha.client import Client, HOST, PORT
 
 
-class Datum(collections.MutableMapping):
+class Datum(collections.abc.MutableMapping):
     ''' allows the user to treat a location in the database like a 'normal'
     python variable that behaves mostly like a dict()
     '''
 
-    def __init__(self, *base: [str], host=HOST, port=PORT) -> None:
+    def __init__(self, *base: [str], host=HOST, port=PORT,
+                 client: Client = None) -> None:
         ''' setup, create client
-        base is our root in the database
+        base is our root in the database. datums created by indexing share
+        their parent's client, so they reuse its connection
         '''
         self._port = port
         self._host = host
         self._base = list(base) if base else ['']
-        self._client = Client(host=host, port=port)
+        self._client = client or Client(host=host, port=port)
+
+    def __enter__(self) -> 'Datum':
+        return self
+
+    def __exit__(self, *_) -> None:
+        ''' close the connection, it's reopened if we're used again
+        '''
+        self._client.close()
 
     def __str__(self) -> None:
         return str(self._client.get(*self._base) or {})
@@ -32,7 +42,9 @@ class Datum(collections.MutableMapping):
     def __getitem__(self, key: str) -> any:
         ''' retrieve a value, returns another Inline for deep indexing
         '''
-        return Datum(*self._base + [key], host=self._host, port=self._port)
+        return Datum(
+            *self._base + [key], host=self._host, port=self._port,
+            client=self._client)
 
     def __setitem__(self, key: str, value: any) -> None:
         ''' assign a value
@@ -59,6 +71,11 @@ class Datum(collections.MutableMapping):
         result = self._client.get(*self._base, default=[], cast=list)
         return result + [value]
 
+    def to_list(self) -> list:
+        ''' the whole value as a list, fetched with one query
+        '''
+        return self._client.get(*self._base, default=[], cast=list)
+
     def keys(self) -> [str]:
         ''' list of keys
         '''
@@ -9,59 +9,196 @@ import socket
 import struct
 
 try:
-    from typing import Tuple
+    from typing import List, Optional, Tuple, Union
 except ImportError:
     pass
 
+# replies at least this large are sent with scatter/gather I/O rather than
+# being copied into one buffer with their header
+SCATTER_THRESHOLD = 2 ** 16
 
-def write(sock: socket.socket, message: str) -> bool:
+# kernel send and receive buffer size for connections
+SOCKET_BUFFER_SIZE = 2 ** 16
+
+
+def configure(sock: socket.socket) -> None:
+    '''
+    set up a connected socket for many small queries and replies: don't wait
+    to coalesce small writes, and give the kernel room for larger messages
+    '''
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+    except OSError:
+        pass
+
+
+def encode(args: List[str]) -> bytes:
+    '''
+    join query arguments into the newline delimited wire format
+    '''
+    return ('\n'.join(args) + '\n').encode('utf-8')
+
+
+def write(sock: socket.socket, message: Union[str, bytes]) -> bool:
     '''
     get the length of the message, pack it, prepend to the message and send it
+
+    messages that are already bytes are sent as is
+    '''
+    try:
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+
+        header = struct.pack('>I', len(message))
+
+        if len(message) < SCATTER_THRESHOLD or not hasattr(sock, 'sendmsg'):
+            sock.sendall(header + message)
+        else:
+            _sendmsg_all(sock, [header, message])
+
+    except (UnicodeError, OSError):
+        return True
+
+    return False
+
+
+def write_many(sock: socket.socket, messages: List[bytes]) -> bool:
+    '''
+    send several encoded messages, each with it's own header, in one call
     '''
     try:
-        raw_message = struct.pack('>I', len(message)) + message.encode('utf-8')
-        sock.sendall(raw_message)
+        sock.sendall(b''.join(
+            struct.pack('>I', len(message)) + message
+            for message in messages))
 
-    except (UnicodeDecodeError, OSError):
+    except OSError:
         return True
 
     return False
 
 
-def read(sock: socket.socket) -> Tuple[str, bool]:
+def _sendmsg_all(sock: socket.socket, buffers: List[bytes]) -> None:
+    '''
+    send all the buffers without joining them, sendmsg may only write part of
+    what it's given so keep going from wherever it stopped
+    '''
+    views = [memoryview(buffer) for buffer in buffers]
+
+    while views:
+        sent = sock.sendmsg(views)
+
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+
+        if views:
+            views[0] = views[0][sent:]
+
+
+def read(sock: socket.socket,
+         buffer: Optional[bytearray] = None) -> Tuple[str, bool]:
     '''
     read the number of bytes in the message, unpack it, then read that many
     bytes and pass the result back to the caller
+
+    callers that read many messages from the same socket may pass a buffer,
+    messages that fit are received into it directly rather than allocating
+    for every message
     '''
+    if buffer is not None:
+        return _read_into(sock, buffer)
+
     failure = ('', True)
 
     raw_msg_len, error = _recv_all(sock, 4)
-    if error or not raw_msg_len:
+    if error or len(raw_msg_len) < 4:
         return failure
 
     msg_len = struct.unpack('>I', raw_msg_len)[0]
     result, error = _recv_all(sock, msg_len)
-    if error:
+    if error or len(result) < msg_len:
         return failure
 
     return result.decode('utf-8'), False
 
 
-def _recv_all(sock: socket.socket, n_bytes: int) -> Tuple[bytes, bool]:
+def read_args(sock: socket.socket,
+              buffer: Optional[bytearray] = None) -> Tuple[List[str], bool]:
     '''
-    read n bytes from a socket
+    read a query and split it into its arguments, dropping empty ones
     '''
-    data = b''
+    data, error = read(sock, buffer)
+    if error:
+        return [], True
+
+    return list(filter(None, data.split('\n'))), False
+
+
+def _read_into(sock: socket.socket, buffer: bytearray) -> Tuple[str, bool]:
+    '''
+    read a message into the buffer. messages that don't fit get a buffer of
+    their own, so one large message doesn't leave the connection holding on
+    to that much memory
+    '''
+    failure = ('', True)
 
-    while len(data) < n_bytes:
+    with memoryview(buffer) as view:
+        if _recv_into(sock, view[:4]):
+            return failure
+        msg_len = struct.unpack_from('>I', view)[0]
+
+    if msg_len > len(buffer):
+        buffer = bytearray(msg_len)
+
+    with memoryview(buffer) as view:
+        if _recv_into(sock, view[:msg_len]):
+            return failure
+        return str(view[:msg_len], 'utf-8'), False
+
+
+def _recv_into(sock: socket.socket, view: memoryview) -> bool:
+    '''
+    fill the view from the socket, true if the socket failed or closed first
+    '''
+    while view:
         try:
-            fragment = sock.recv(n_bytes - len(data))
+            received = sock.recv_into(view)
         except OSError:
-            return b'', True
+            return True
 
-        if not fragment:
-            break
-        else:
-            data += fragment
+        if not received:
+            return True
+
+        view = view[received:]
+
+    return False
+
+
+def _recv_all(sock: socket.socket,
+              n_bytes: int) -> Tuple[bytearray, bool]:
+    '''
+    read n bytes from a socket, received directly into one preallocated
+    buffer rather than joining fragments
+    '''
+    data = bytearray(n_bytes)
+    received = 0
+
+    with memoryview(data) as view:
+        while received < n_bytes:
+            try:
+                count = sock.recv_into(view[received:])
+            except OSError:
+                return bytearray(), True
+
+            if not count:
+                break
+            received += count
+
+    if received < n_bytes:
+        del data[received:]
 
     return data, False
@@ -9,6 +9,7 @@
 abstraction of a server that allows communciation with other nodes
 '''
 
+import logging
 import os
 import queue
 import socket
@@ -23,6 +24,10 @@ import apocrypha.exceptions as exceptions
 import apocrypha.network as network
 import apocrypha.server as server
 
+_NODE_PREFIX = b'--node\n'
+
+logger = logging.getLogger(__name__)
+
 
 class NodeHandler(socketserver.BaseRequestHandler):
     '''
@@ -30,27 +35,36 @@ class NodeHandler(socketserver.BaseRequestHandler):
     response back to the client, then maybe forward the query on to peers
     '''
 
+    def setup(self) -> None:
+        ''' none -> none
+
+        queries are received into the same buffer for the whole connection
+        '''
+        network.configure(self.request)
+        self.buffer = bytearray(network.SOCKET_BUFFER_SIZE)
+
     def handle(self) -> None:
         ''' none -> none
+
+        the node's workers call handle_query() each time the client sends us
+        something
         '''
         self.server.add_socket(self.request)
-        client_alive = True
-
-        while client_alive:
-            client_alive = self._handle()
 
+    def close(self) -> None:
+        ''' none -> none
+        '''
         self.server.remove_socket(self.request)
 
-    def _handle(self) -> None:
+    def handle_query(self) -> bool:
         ''' none -> bool
 
-        read in a loop so we can handle multiple requests
+        read one query and reply to it, false when the client is gone
         '''
         # get the query
-        data, error = network.read(self.request)
+        parsed, error = network.read_args(self.request, self.buffer)
         if error:
             return False
-        parsed = [_ for _ in data.split('\n') if _]
 
         with self.server.lock:
 
@@ -63,13 +77,16 @@ class NodeHandler(socketserver.BaseRequestHandler):
 
                 return True
 
-            # get result from local server
+            # get result from local server, the reply is passed through to
+            # the client as is
             try:
-                result = self.server.local.query(parsed)
-                result = '\n'.join(result) + '\n'
+                result = self.server.local.query_raw(network.encode(parsed))
             except exceptions.DatabaseError as error:
                 result = '\n' + str(error) + '\n'
                 forward = False
+            else:
+                if result.startswith('error: '):
+                    forward = False
 
             error = network.write(self.request, result)
             if error:
@@ -82,7 +99,7 @@ class NodeHandler(socketserver.BaseRequestHandler):
         return True
 
 
-class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
+class Node(server.WorkerPoolMixIn, socketserver.TCPServer):
     '''
     a server that forwards requests onto a local database server and
     potentially remote nodes
@@ -134,10 +151,7 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
         # node server
         self._sockets = []
-        socketserver.TCPServer.__init__(
-            self,
-            ('0.0.0.0', node_addr[1]),
-            handler)
+        super().__init__(('0.0.0.0', node_addr[1]), handler)
 
     def add_socket(self, sock: socket.socket) -> None:
         ''' safely add a socket to our list
@@ -160,10 +174,11 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
         while self.running.is_set():
             try:
                 data = self.messages.get(timeout=Node.tick)
+                message = _NODE_PREFIX + network.encode(data)
 
                 for peer in list(self.peers.values()):
                     try:
-                        self._recoverable_query(peer, ['--node'] + data)
+                        self._recoverable_query(peer, message)
                     except exceptions.FailedQuery:
                         pass
 
@@ -188,20 +203,18 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
         tell our own threads to stop, shutdown the server
         '''
         with self.lock:
-            for sock in self._sockets:
-                sock.shutdown(socket.SHUT_RDWR)
-                sock.close()
-
+            self.wake_workers(self._sockets)
             self.running.clear()
-            self.shutdown()
-            self.server_close()
-            self.server.teardown()
 
-    def _log(self, msg: str) -> None:
-        ''' print a message
+        self.shutdown()
+        self.server_close()
+        self.server.teardown()
+
+    def _log(self, msg: str, *args) -> None:
+        ''' log a debug message, nothing is formatted unless it'll be shown
         '''
-        name = self.info['identity'][:4]
-        print('{n} {m}'.format(n=name, m=msg))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s ' + msg, self.info['identity'][:4], *args)
 
     def _find_initial_peers(self) -> set:
         ''' none -> set of (str, int,)
@@ -279,14 +292,14 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
             if my_identity not in their_peers:
                 try:
                     self._log(
-                        'sending connect message {h}:{p}'
-                        .format(h=peer.host, p=peer.port))
+                        'sending connect message %s:%s', peer.host, peer.port)
 
                     self._recoverable_query(
-                        peer, ['--connect', my_host, str(my_port)])
+                        peer,
+                        network.encode(['--connect', my_host, str(my_port)]))
                 except exceptions.FailedQuery:
                     pass
-            self._log('finished connecting to ' + peer.identity)
+            self._log('finished connecting to %s', peer.identity)
 
         self.peers_to_join = failed_connections
 
@@ -301,9 +314,7 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
                 self._recoverable_get(peer, 'internal', 'local', 'startup'))
 
             if their_startup < our_startup:
-                self._log(
-                    'merging with {h}:{p}'
-                    .format(h=peer.host, p=peer.port))
+                self._log('merging with %s:%s', peer.host, peer.port)
 
                 their_db = self._recoverable_get(peer)
                 our_db = self.local.get()
@@ -317,17 +328,21 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
         except exceptions.FailedQuery:
             pass
 
-    def _recoverable_query(self, peer, keys):
-        ''' Peer, list of str -> ?
+    def _recoverable_query(self, peer, message):
+        ''' Peer, bytes -> str
 
-        make a query against the remote peer, if something goes wrong attempt
-        to reconnect
+        send an encoded query to the remote peer, if something goes wrong
+        attempt to reconnect
         '''
         try:
-            return peer.client.query(keys)
+            result = peer.client.query_raw(message)
+            if result.startswith('error: '):
+                raise exceptions.DatabaseError(result.split('\n')[0])
+
+            return result
 
         except (ConnectionError, exceptions.DatabaseError) as error:
-            self._log('{e}: {i}'.format(i=peer.identity, e=error))
+            self._log('%s: %s', error, peer.identity)
             self._recover_peer(peer)
             raise exceptions.FailedQuery from None
 
@@ -341,7 +356,7 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
             return peer.client.get(*keys, default=default, cast=cast)
 
         except (ConnectionError, exceptions.DatabaseError) as error:
-            self._log('{e}: {i}'.format(i=peer.identity, e=error))
+            self._log('%s: %s', error, peer.identity)
             self._recover_peer(peer)
             raise exceptions.FailedQuery from None
 
@@ -370,8 +385,7 @@ class Node(socketserver.ThreadingMixIn, socketserver.TCPServer):
         we hit an error talking to a peer we've successfull connected to
         before, add them back to peers_to_join
         '''
-        self._log('attempting to recover {h}:{p}'.format(
-            h=peer.host, p=peer.port))
+        self._log('attempting to recover %s:%s', peer.host, peer.port)
 
         if peer.identity in self.peers:
             del self.peers[peer.identity]
@@ -415,7 +429,7 @@ class Peer():
         if a connection cannot be made, return None
         '''
         self._name = name
-        self._log('attempting to connect to {h}:{p}'.format(h=host, p=port))
+        self._log('attempting to connect to %s:%s', host, port)
 
         try:
             self.host = host    # str
@@ -423,17 +437,17 @@ class Peer():
             self.client = client.Client(host=host, port=port)
             self.identity = self.client.get(
                 '--node', 'internal', 'local', 'identity')
-            self._log('peer connection established with {i}'.format(
-                i=self.identity))
+            self._log('peer connection established with %s', self.identity)
 
         except (exceptions.DatabaseError, TimeoutError, OSError):
-            self._log('could not connect to {h}:{p}'.format(h=host, p=port))
+            self._log('could not connect to %s:%s', host, port)
             raise exceptions.PeerCreateFailed
 
-    def _log(self, msg: str) -> None:
-        ''' print a message
+    def _log(self, msg: str, *args) -> None:
+        ''' log a debug message, nothing is formatted unless it'll be shown
         '''
-        print('{n} {m}'.format(n=self._name[:4], m=msg))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s ' + msg, self._name[:4], *args)
 
     def database_representation(self):
         '''
@@ -451,6 +465,8 @@ def main():  # pragma: no cover
     create the node, handle teardown
     '''
 
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+
     parser = server.get_argument_parser()
     db_lort = os.environ['AP_LORT'] if 'AP_LORT' in os.environ else 9998
 
@@ -465,7 +481,8 @@ def main():  # pragma: no cover
 
     server_database = server.ServerDatabase(
         args.config,
-        stateless=args.stateless)
+        stateless=args.stateless,
+        cache_size=args.cache_size)
 
     node = Node(
         node_address,
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+# pylint: disable=no-member
+
+'''
+JSON encoding and decoding, uses orjson when it's installed and falls back to
+the standard library otherwise. both produce the same output, anything orjson
+can't write the way json would, like integers past 64 bits or NaN, is left to
+json
+'''
+
+import json
+import math
+
+try:
+    from typing import Any, Union
+except ImportError:
+    pass
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+
+
+def loads(data: Union[str, bytes, memoryview]) -> Any:
+    '''
+    parse a JSON document, raises ValueError when it's malformed
+    '''
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is stricter about some valid documents, like integers
+            # larger than 64 bits. let json decide
+            pass
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+
+    return json.loads(data)
+
+
+def _non_finite(value: Any) -> bool:
+    '''
+    whether there's a NaN or infinity anywhere in the value. orjson writes
+    these as null, json keeps them, so the value has to go through json
+    '''
+    pending = [value]
+
+    while pending:
+        value = pending.pop()
+
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, list):
+            pending.extend(value)
+
+    return False
+
+
+def dumps(value: Any) -> bytes:
+    '''
+    compact UTF-8 encoded JSON, for machines
+    '''
+    if orjson:
+        try:
+            result = orjson.dumps(value)
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            # only look for non-finite numbers when they may have been lost
+            if b'null' not in result or not _non_finite(value):
+                return result
+
+    return json.dumps(
+        value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def dumps_pretty(value: Any) -> str:
+    '''
+    indented JSON with sorted keys, for people to read and edit
+    '''
+    if orjson:
+        try:
+            result = orjson.dumps(
+                value, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        except orjson.JSONEncodeError:
+            pass
+        else:
+            if b'null' not in result or not _non_finite(value):
+                return result.decode()
+
+    return json.dumps(
+        value, indent=2, sort_keys=True, ensure_ascii=False)
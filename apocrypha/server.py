@@ -7,9 +7,14 @@ server and handler for database
 '''
 
 import argparse
+import itertools
 import os
+import queue
+import reprlib
+import selectors
 import socket
 import socketserver
+import sys
 import threading
 import time
 
@@ -17,7 +22,25 @@ import apocrypha.database as database
 import apocrypha.exceptions as exceptions
 import apocrypha.network as network
 
-MILLISECONDS = 10 ** 5
+# flags that may lead a query, and what they turn on
+_FLAGS = {
+    '-c': 'context', '--context': 'context',
+    '-s': 'strict', '--strict': 'strict'}
+
+# distinguishes a cache miss from a cached empty result
+_MISS = object()
+
+# log lines waiting to be written, past this they're dropped rather than
+# slowing down queries
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
+
+# query arguments are only shown in part in the log, reprlib gives up once
+# it's written enough instead of building the whole string to throw it away
+_argrepr = reprlib.Repr()
+_argrepr.maxlist = 6
+_argrepr.maxstring = 40
+_argrepr.maxother = 40
 
 
 class ServerDatabase(database.Database):
@@ -25,39 +48,63 @@ class ServerDatabase(database.Database):
     wrapper around Database that provides caching
     '''
 
-    def __init__(self, path, stateless=False):
+    def __init__(self, path, stateless=False,
+                 cache_size=database.CACHE_SIZE, initial_data=None):
         ''' filepath -> ApocryphaServer
 
-        @path       full path to the database json file
+        @path           full path to the database json file
+        @cache_size     most query results to keep in the cache
+        @initial_data   already loaded data to use instead of reading path
         '''
-        database.Database.__init__(self, path, stateless=stateless)
+        database.Database.__init__(
+            self, path, stateless=stateless, cache_size=cache_size,
+            initial_data=initial_data)
 
-    def action(self, args):
-        ''' list of string -> none
+    def action(self, args, cache_key=None):
+        ''' list of string, maybe tuple of string -> bool
 
         @args       arguments from the user
+        @cache_key  tuple(args), if the caller already built it
 
-        updates self.output with the result of the query
+        updates self.output with the encoded result of the query, returns
+        False when the result came from the cache and the database wasn't
+        touched
 
         caching is not allowed for queries that include references or where
-        context is requested
+        context is requested. cached results were produced without the context
+        or strict flags, so they're not used when either is set
         '''
 
-        # all other queries
-        cache_key = tuple(args)
+        if cache_key is None:
+            cache_key = tuple(args)
+        self.root = database.root_key(cache_key)
+
+        if not (self.add_context or self.strict):
+            cached = self.cache.get(cache_key, _MISS)
+
+            if cached is not _MISS:
+                self.output = cached
+                return False
 
-        if cache_key in self.cache:
-            self.output = self.cache[cache_key]
+        self._action(self.data, args)
 
+        # cache and reply with what goes out on the wire, so cache hits don't
+        # need to be joined or encoded again
+        if self.output:
+            self.output = ('\n'.join(self.output) + '\n').encode('utf-8')
         else:
-            self._action(self.data, args)
+            self.output = b''
 
-            if self.output:
-                self.output = '\n'.join(self.output) + '\n'
-            else:
-                self.output = ''
+        self._maybe_cache(args, cache_key)
+        return True
 
-            self._maybe_cache(args)
+    def lookup(self, cache_key):
+        ''' tuple of str -> bytes | None
+
+        the cached result of a query, none if it's not cached. this doesn't
+        need the database lock
+        '''
+        return self.cache.get(cache_key)
 
 
 class ServerHandler(socketserver.BaseRequestHandler):
@@ -65,96 +112,293 @@ class ServerHandler(socketserver.BaseRequestHandler):
     read query off of the client socket, parse arguments, send response
     '''
 
+    def setup(self):
+        ''' none -> none
+
+        queries are received into the same buffer for the whole connection
+        '''
+        network.configure(self.request)
+        self.buffer = bytearray(network.SOCKET_BUFFER_SIZE)
+
     def handle(self):
         ''' none -> none
 
-        self.request is the TCP socket connected to the client
+        self.request is the TCP socket connected to the client. the server's
+        workers call handle_query() each time the client sends us something
         '''
         self.server.add_socket(self.request)
-        client_okay = True
 
-        while client_okay:
-            client_okay = self._handle()
+    def close(self):
+        ''' none -> none
 
+        the client is gone, forget about them
+        '''
         self.server.remove_socket(self.request)
 
-    def _handle(self):
-        ''' none -> none
+    def handle_query(self):
+        ''' none -> bool
+
+        read one query and reply to it, false when the client is gone
         '''
-        data, error = network.read(self.request)
+        args, error = network.read_args(self.request, self.buffer)
         if error:
             return False
 
-        with self.server.database.lock:
-            start_time = _now()
-            args = self._parse_arguments(data)
-            result = ''
+        # this runs for every query, so look the database up once
+        server = self.server
+        db = server.database
 
-            try:
-                self.server.database.action(args)
-                result = self.server.database.output
+        start_time = time.monotonic_ns()
+        context, strict, args = _parse_arguments(args)
 
-            # user, usage error
-            except exceptions.DatabaseError as error:
-                result = str(error)
+        # the key is built once and used for both the lookup and a miss
+        cache_key = tuple(args)
 
-            # send reply to client
-            error = network.write(self.request, result)
-            if error:
-                return False
+        # cache hits only read the cache, so they don't wait for the database
+        result = None
+        if not (context or strict):
+            result = db.lookup(cache_key)
 
-            end_time = _now()
-            query_duration = (end_time - start_time) / MILLISECONDS
+        if result is None:
+            result = self._query_locked(args, cache_key, context, strict)
 
-            # reset internal values, save changes if needed
-            self.server.database.post_action()
+        query_duration = (time.monotonic_ns() - start_time) / 1e9
+
+        # send reply to client. the result is already detached from the
+        # database, so a slow client doesn't hold the lock for everyone else
+        error = network.write(self.request, result)
+        if error:
+            return False
 
-        self._log(args, query_duration)
+        if not server.quiet:
+            self._log(args, query_duration)
         return True
 
-    def _parse_arguments(self, data):
-        ''' none -> none
+    def _query_locked(self, args, cache_key, context, strict):
+        ''' list of str, tuple of str, bool, bool -> bytes | str
 
-        arguments are delimited by newlines, remove empty elements
+        run a query that may touch the database, holding its lock
         '''
+        db = self.server.database
 
-        args = data.split('\n') if data else []
-        args = [arg for arg in args if arg]
-
-        while args and args[0] in {'-c', '--context', '-s', '--strict'}:
+        with db.lock:
+            db.add_context = context
+            db.strict = strict
 
-            if args[0] in {'-c', '--context'}:
-                self.server.database.add_context = True
+            try:
+                touched = db.action(args, cache_key)
+                result = db.output
 
-            if args[0] in {'-s', '--strict'}:
-                self.server.database.strict = True
+            # user, usage error
+            except exceptions.DatabaseError as error:
+                touched = True
+                result = str(error)
 
-            args = args[1:]
+            # reset internal values, save changes if needed. cache hits
+            # didn't change anything, so there's nothing to normalize
+            if touched:
+                db.post_action()
+            else:
+                db.reset()
 
-        return args
+        return result
 
     def _log(self, args, duration):
         ''' list of string -> none
         '''
-        if self.server.quiet:
-            return
-
         name = '?'
         if 'internal' in self.server.database.data:
             local = self.server.database.data['internal']['local']
             name = local.get('identity', '?')[:4]
 
         cache_size = len(self.server.database.cache)
-        args = str(args)[:70]
+        self.server.log(name, duration, cache_size, args)
+
+
+class WorkerPoolMixIn():
+    '''
+    serve connections from a fixed pool of worker threads instead of starting
+    a thread per connection. each worker watches its connections with a
+    selector and answers whichever client has a query ready
+
+    handlers register the connection in handle(), answer one query per call to
+    handle_query(), and are told the connection is done with close()
+
+    handle_query() reads the whole query once the connection is readable, and
+    writes the whole reply. a client that stops partway through a message, or
+    stops reading its replies, holds up the other connections on its worker,
+    so it's dropped once it's been stalled for client_timeout seconds
+    '''
+    pool_size = os.cpu_count() or 1
+    poll_interval = 0.5
+    client_timeout = 1.0
+
+    # socketserver only queues 5 connections, any more clients connecting at
+    # once have their SYN dropped and wait a second to retry
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, *args, **kwargs):
+        ''' server arguments -> none
+
+        set up the pool's state before binding, a failed bind calls
+        server_close() on the way out
+        '''
+        self.pool_running = threading.Event()
+        self._pool = []
+        self._next_worker = None
+        super().__init__(*args, **kwargs)
+
+    def server_activate(self):
+        ''' none -> none
+
+        start listening, then start the workers
+        '''
+        socketserver.TCPServer.server_activate(self)
+
+        self.pool_running.set()
+        self._pool = [_Worker(self) for _ in range(self.pool_size)]
+        self._next_worker = itertools.cycle(self._pool)
+
+        for worker in self._pool:
+            worker.thread.start()
+
+    def process_request(self, request, client_address):
+        ''' socket, (str, int) -> none
+
+        create the handler and give the connection to the next worker
+        '''
+        request.settimeout(self.client_timeout)
+
+        # pylint: disable=no-member
+        handler = self.RequestHandlerClass(request, client_address, self)
+        next(self._next_worker).add(request, client_address, handler)
 
-        print('{n} {t:.5f} {c:2} {a}'.format(
-            n=name,
-            t=duration,
-            c=cache_size,
-            a=args))
+    def wake_workers(self, sockets):
+        ''' list of socket -> none
 
+        wake up any worker that's blocked on one of these clients, the workers
+        close them
+        '''
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def server_close(self):
+        ''' none -> none
+
+        stop listening, stop the workers. they close their own connections
+        '''
+        socketserver.TCPServer.server_close(self)
+        self.pool_running.clear()
+
+        for worker in self._pool:
+            worker.wakeup()
+
+        for worker in self._pool:
+            if worker.thread is not threading.current_thread():
+                worker.thread.join()
+
+
+class _Worker():
+    '''
+    one thread of a WorkerPoolMixIn, and the connections it's responsible for
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.pending = queue.Queue()
+        self.selector = selectors.DefaultSelector()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        # the acceptor writes here to interrupt select() when there's a new
+        # connection for us, or when it's time to stop
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ)
 
-class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    def add(self, request, client_address, handler):
+        ''' socket, (str, int), BaseRequestHandler -> none
+
+        called from the accepting thread
+        '''
+        self.pending.put((request, client_address, handler))
+        self.wakeup()
+
+    def wakeup(self):
+        ''' none -> none
+        '''
+        try:
+            self._wakeup_send.send(b'\0')
+        except OSError:
+            pass
+
+    def run(self):
+        ''' none -> none
+
+        serve queries until the pool is stopped
+        '''
+        while self.server.pool_running.is_set():
+            ready = self.selector.select(timeout=self.server.poll_interval)
+
+            for key, _ in ready:
+                if key.fileobj is self._wakeup_recv:
+                    self._register_pending()
+                else:
+                    self._serve(key)
+
+        self._register_pending()
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is not self._wakeup_recv:
+                self._finish(key)
+
+        self.selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def _register_pending(self):
+        ''' none -> none
+        '''
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except OSError:
+            pass
+
+        while not self.pending.empty():
+            request, client_address, handler = self.pending.get()
+            self.selector.register(
+                request, selectors.EVENT_READ, (client_address, handler))
+
+    def _serve(self, key):
+        ''' selectors.SelectorKey -> none
+
+        the client sent something, usually a query
+        '''
+        client_address, handler = key.data
+
+        try:
+            client_okay = handler.handle_query()
+
+        except Exception:  # pylint: disable=broad-except
+            self.server.handle_error(key.fileobj, client_address)
+            client_okay = False
+
+        if not client_okay:
+            self._finish(key)
+
+    def _finish(self, key):
+        ''' selectors.SelectorKey -> none
+        '''
+        _, handler = key.data
+
+        self.selector.unregister(key.fileobj)
+        handler.close()
+        self.server.shutdown_request(key.fileobj)
+
+
+class Server(WorkerPoolMixIn, socketserver.TCPServer):
     ''' none -> socketserver.TCPServer
 
     allow address reuse for faster restarts
@@ -164,14 +408,67 @@ class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
     def __init__(self, server_address, handler, db, quiet=False):
         ''' (str, int,), BaseRequestHandler, Database, bool -> Server
         '''
-        socketserver.TCPServer.__init__(
-            self, server_address, handler)
+        super().__init__(server_address, handler)
         self.database = db
         self.quiet = quiet
 
         self._lock = threading.Lock()
         self._sockets = []
 
+        self._log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        self._log_dropped = 0
+        self._log_thread = threading.Thread(
+            target=self._log_writer, daemon=True)
+        if not quiet:
+            self._log_thread.start()
+
+    def log(self, name, duration, cache_size, args):
+        ''' str, float, int, list of str -> none
+
+        queue a query for the log writer, formatting and writing happen there
+        so the handler can get back to its clients
+        '''
+        try:
+            self._log_queue.put_nowait((name, duration, cache_size, args))
+        except queue.Full:
+            with self._lock:
+                self._log_dropped += 1
+
+    def _log_writer(self):
+        ''' none -> none
+
+        callback for _log_thread, writes whatever has queued up in one go
+        '''
+        running = True
+
+        while running:
+            entries = [self._log_queue.get()]
+            while len(entries) < LOG_BATCH_SIZE and \
+                    not self._log_queue.empty():
+                entries.append(self._log_queue.get_nowait())
+
+            lines = []
+            for entry in entries:
+                if entry is None:
+                    running = False
+                    continue
+
+                name, duration, cache_size, args = entry
+                lines.append('{n} {t:.5f} {c:2} {a}\n'.format(
+                    n=name,
+                    t=duration,
+                    c=cache_size,
+                    a=_argrepr.repr(args)[:70]))
+
+            # say so when the queue overflowed, rather than leaving gaps
+            with self._lock:
+                dropped, self._log_dropped = self._log_dropped, 0
+            if dropped:
+                lines.append('{d} log lines dropped\n'.format(d=dropped))
+
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+
     def add_socket(self, sock: socket.socket) -> None:
         ''' safely add a socket to our list
         '''
@@ -190,19 +487,35 @@ class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
         stop database writer thread, stop our own threads
         '''
         with self._lock:
-            for sock in self._sockets:
-                sock.shutdown(socket.SHUT_RDWR)
-                sock.close()
+            self.wake_workers(self._sockets)
+
+        self.shutdown()
+        self.server_close()
+        self.database.stop_writer()
 
-            self.database.writer_running.clear()
-            self.shutdown()
-            self.server_close()
+        if self._log_thread.is_alive():
+            self._log_queue.put(None)
+            self._log_thread.join()
 
 
-def _now():
-    ''' none -> int
+def _parse_arguments(args):
+    ''' list of str -> bool, bool, list of str
+
+    strip leading flags off the query, returning whether context and strict
+    mode were requested
     '''
-    return int(round(time.time() * MILLISECONDS))
+    # most queries don't have any
+    if not args or args[0] not in _FLAGS:
+        return False, False, args
+
+    flags = {'context': False, 'strict': False}
+    start = 0
+
+    while start < len(args) and args[start] in _FLAGS:
+        flags[_FLAGS[args[start]]] = True
+        start += 1
+
+    return flags['context'], flags['strict'], args[start:]
 
 
 def get_argument_parser() -> argparse.ArgumentParser:  # pragma: no cover
@@ -233,6 +546,9 @@ def get_argument_parser() -> argparse.ArgumentParser:  # pragma: no cover
     parser.add_argument(
         '--stateless', action='store_true',
         help="do not persist to disk")
+    parser.add_argument(
+        '--cache-size', type=int, default=database.CACHE_SIZE,
+        help="most query results to keep in the cache")
 
     return parser
 
@@ -248,7 +564,8 @@ def main():  # pragma: no cover
     # Create the tcp server
     server_database = ServerDatabase(
         args.config,
-        stateless=args.stateless)
+        stateless=args.stateless,
+        cache_size=args.cache_size)
 
     server = Server(
         (args.host, args.port),
@@ -7,5 +7,6 @@ coverage run --branch -a --source apocrypha/ test/test_server.py
 coverage run --branch -a --source apocrypha/ test/test_node.py
 coverage run --branch -a --source apocrypha/ test/test_network.py
 coverage run --branch -a --source apocrypha/ test/test_datum.py
+coverage run --branch -a --source apocrypha/ test/test_serialize.py
 
 coverage html
@@ -4,10 +4,16 @@
 # pylint: disable=no-self-use
 # pylint: disable=missing-docstring
 
+import json
+import math
+import os
+import tempfile
 import unittest
+from unittest import mock
+import zlib
 
 import apocrypha.database
-from apocrypha.database import WRITE_OPS, READ_OPS
+from apocrypha.database import WRITE_OPS, READ_OPS, LRUCache
 from apocrypha.exceptions import DatabaseError
 
 
@@ -41,6 +47,10 @@ class TestDatabase(unittest.TestCase):
         '''
         Database(testdb)
 
+    def test_operators_dispatched(self):
+        a = Database(testdb)
+        self.assertEqual(set(a._operators), apocrypha.database.OPERATORS)
+
     def test_no_db(self):
         a = Database('file-that-does-not-exist')
         self.assertEqual(a.data, {})
@@ -49,6 +59,29 @@ class TestDatabase(unittest.TestCase):
         with self.assertRaises(DatabaseError):
             Database('test/test_database_action.py')
 
+    def test_empty_db(self):
+        with tempfile.NamedTemporaryFile() as filep:
+            with self.assertRaises(DatabaseError):
+                Database(filep.name)
+
+    def test_compressed_db(self):
+        data = {'a': ['b', 'c'], 'd': {'e': 'ø'}}
+
+        with tempfile.NamedTemporaryFile() as filep:
+            filep.write(zlib.compress(json.dumps(data).encode()))
+            filep.flush()
+
+            self.assertEqual(Database(filep.name).data, data)
+
+    def test_initial_data(self):
+        data = {'a': ['b', 'c']}
+        a = apocrypha.database.Database(
+            'does/not/exist.json', stateless=True, initial_data=data)
+
+        self.assertIs(a.data, data)
+        a.action(['a'])
+        self.assertEqual(a.output, ['b', 'c'])
+
     def test_index(self):
         '''
         $ d a
@@ -413,7 +446,7 @@ class TestDatabaseEdit(unittest.TestCase):
         ])
 
         self.assertEqual(
-            a.output, ['{\n    "a": "1",\n    "b": "2",\n    "c": "3"\n}'])
+            a.output, ['{\n  "a": "1",\n  "b": "2",\n  "c": "3"\n}'])
 
     def test_edit_singleton(self):
         a = run([
@@ -591,7 +624,7 @@ class TestCache(unittest.TestCase):
         output = {
             ('apple', '-e'): 'value', ('apple', '--keys'): 'value',
             ('apple', '-k'): 'value', ('apple', '--edit'): 'value',
-            ('key',): 'value'}
+            ('apple', '@'): 'value', ('key',): 'value'}
 
         self.assertEqual(a.cache, output)
 
@@ -603,5 +636,176 @@ class TestCache(unittest.TestCase):
             self.assertEqual(a.cache, {})
 
 
+class TestPostAction(unittest.TestCase):
+
+    def test_read_not_normalized(self):
+        a = run([['apple', '=', 'sauce']])
+        a.post_action()
+
+        a.action(['apple'])
+        with mock.patch.object(a, '_normalize') as normalize:
+            a.post_action()
+        normalize.assert_not_called()
+
+    def test_placeholder_removed(self):
+        a = Database(testdb)
+        a.action(['nonexistent', 'key'])
+        self.assertIn('nonexistent', a.data)
+
+        a.post_action()
+        self.assertNotIn('nonexistent', a.data)
+
+    def test_partial_remove(self):
+        '''
+        a removal that fails part way through still counts as a write
+        '''
+        a = run([['list', '=', 'x', 'y']])
+        a.post_action()
+
+        a.action(['list'])
+        a._maybe_cache(['list'])
+        a.post_action()
+
+        with self.assertRaises(DatabaseError):
+            a.action(['list', '-', 'x', 'z'])
+        a.post_action()
+
+        self.assertEqual(a.data['list'], 'y')
+        self.assertNotIn(('list',), a.cache)
+
+
+class TestWriter(unittest.TestCase):
+
+    def test_written_on_stop(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.json')
+
+            a = apocrypha.database.Database(path)
+            a.action(['apple', '=', 'sauce'])
+            a.post_action()
+            a.stop_writer()
+
+            self.assertFalse(os.path.exists(path + '.tmp'))
+            self.assertEqual(Database(path).data, {'apple': 'sauce'})
+
+    def test_writes_coalesced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.json')
+            a = apocrypha.database.Database(path)
+
+            with mock.patch.object(a, '_write', wraps=a._write) as write:
+
+                # hold the writer off until every change is queued, however
+                # long they take
+                with mock.patch.object(a._write_event, 'set') as wake:
+                    for i in range(0, 10):
+                        a.action(['apple', '=', str(i)])
+                        a.post_action()
+
+                wake.assert_called()
+
+                a.stop_writer()
+
+            self.assertEqual(write.call_count, 1)
+            self.assertEqual(Database(path).data, {'apple': '9'})
+
+    def test_non_finite_round_trip(self):
+        ''' NaN and infinities survive being saved and loaded again
+        '''
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.json')
+
+            a = apocrypha.database.Database(path)
+            a.action(['numbers', '--set', '[NaN, Infinity, -Infinity, 1.5]'])
+            a.post_action()
+            a.stop_writer()
+
+            b = Database(path)
+            numbers = b.data['numbers']
+            self.assertTrue(math.isnan(numbers[0]))
+            self.assertEqual(numbers[1:], [math.inf, -math.inf, 1.5])
+
+            b.action(['numbers', '--edit'])
+            self.assertEqual(
+                b.output, ['[\n  NaN,\n  Infinity,\n  -Infinity,\n  1.5\n]'])
+
+    def test_no_write_without_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'db.json')
+
+            a = apocrypha.database.Database(path)
+            a.action(['apple'])
+            a.post_action()
+            a.stop_writer()
+
+            self.assertFalse(os.path.exists(path))
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evict_oldest(self):
+        cache = LRUCache(max_size=2)
+        cache[('a',)] = 'a'
+        cache[('b',)] = 'b'
+        cache[('c',)] = 'c'
+
+        self.assertEqual(cache, {('b',): 'b', ('c',): 'c'})
+
+    def test_get_refreshes(self):
+        cache = LRUCache(max_size=2)
+        cache[('a',)] = 'a'
+        cache[('b',)] = 'b'
+
+        self.assertEqual(cache.get(('a',)), 'a')
+        cache[('c',)] = 'c'
+
+        self.assertEqual(cache, {('a',): 'a', ('c',): 'c'})
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache[('a',)] = 'a'
+        cache[('a', 'b')] = 'b'
+        cache[('c',)] = 'c'
+        cache[()] = 'root'
+        cache[('-k',)] = 'keys'
+
+        cache.invalidate('a')
+        self.assertEqual(cache, {('c',): 'c'})
+        self.assertEqual(cache.index, {'c': {('c',)}})
+
+    def test_evict_unindexed(self):
+        cache = LRUCache(max_size=1)
+        cache[('a',)] = 'a'
+        cache[('b',)] = 'b'
+
+        self.assertNotIn('a', cache.index)
+        self.assertEqual(cache.index, {'b': {('b',)}})
+
+    def test_get_default(self):
+        cache = LRUCache()
+        self.assertEqual(cache.get(('a',), 'default'), 'default')
+
+    def test_cleared_on_write(self):
+        a = Database(testdb)
+
+        a.output = 'value'
+        a._maybe_cache(['key'])
+        a.action(['key', '=', 'value'])
+        a.post_action()
+
+        self.assertIsInstance(a.cache, LRUCache)
+        self.assertEqual(a.cache, {})
+
+    def test_cache_size(self):
+        a = apocrypha.database.Database(
+            testdb, stateless=True, cache_size=1)
+
+        for key in ['a', 'b']:
+            a.output = key
+            a._maybe_cache([key])
+
+        self.assertEqual(a.cache, {('b',): 'b'})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -20,14 +20,14 @@ class TestSearch(unittest.TestCase):
     ''' search '''
 
     def setUp(self):
-        DB.post_action()
+        DB.reset()
 
 
 class TestAppend(unittest.TestCase):
     ''' append '''
 
     def setUp(self):
-        DB.post_action()
+        DB.reset()
 
     def test_create_new_value_single(self):
         ''' single to single '''
@@ -100,7 +100,7 @@ class TestAssign(unittest.TestCase):
     ''' assign '''
 
     def setUp(self):
-        DB.post_action()
+        DB.reset()
 
     def test_single(self):
         ''' basic assignment '''
@@ -134,7 +134,7 @@ class TestKeys(unittest.TestCase):
     ''' keys '''
 
     def setUp(self):
-        DB.post_action()
+        DB.reset()
 
     def test_no_keys(self):
         base = {}
@@ -157,6 +157,21 @@ class TestKeys(unittest.TestCase):
         DB._keys(base, left)
         self.assertEqual(DB.output, ['a', 'b'])
 
+    def test_empty_key(self):
+        base = {'': 1, 'a': 2}
+        left = 'a'
+
+        DB._keys(base, left)
+        self.assertEqual(DB.output, ['', 'a'])
+
+    def test_reference_keys(self):
+        ''' keys that are references are still followed '''
+        db = apocrypha.database.Database(CFG, stateless=True)
+        db.data = {'b': 'value', 'x': {'!b': 1, 'a': 2, ' ': 3}}
+
+        db._keys(db.data['x'], 'x')
+        self.assertEqual(db.output, ['value', ' ', 'a'])
+
     def test_error_keys_on_non_dict(self):
         ''' cannot get keys on a non dict '''
         base = []
@@ -174,7 +189,7 @@ class TestSet(unittest.TestCase):
     ''' set '''
 
     def setUp(self):
-        DB.post_action()
+        DB.reset()
 
     def test_simple(self):
         base = {'a': 1}
@@ -211,6 +226,23 @@ class TestSet(unittest.TestCase):
         self.assertEqual(base[left], 1)
         self.assertFalse(DB.write_needed)
 
+    def test_write_if_type_changes(self):
+        base = {'a': 1}
+        left = 'a'
+        right = 'true'
+
+        DB._set(base, left, right)
+        self.assertIs(base[left], True)
+        self.assertTrue(DB.write_needed)
+
+    def test_no_write_if_equal_nested(self):
+        base = {'a': {'b': [1, 2, {'c': 'd'}]}}
+        left = 'a'
+        right = '{"b": [1, 2, {"c": "d"}]}'
+
+        DB._set(base, left, right)
+        self.assertFalse(DB.write_needed)
+
     def test_error_not_json(self):
         base = {'a': 1}
         left = 'a'
@@ -225,7 +257,7 @@ class TestRemove(unittest.TestCase):
     ''' remove one or more elements from anything '''
 
     def setUp(self):
-        DB.post_action()
+        DB.reset()
 
     def test_one_from_single(self):
         base = {'a': 1}
@@ -304,7 +336,7 @@ class TestPop(unittest.TestCase):
     ''' pop '''
 
     def setUp(self):
-        DB.post_action()
+        DB.reset()
 
     def test_nothing(self):
         ''' nothing to pop, nothing to show and don't write out the db '''
@@ -351,4 +383,4 @@ class TestPop(unittest.TestCase):
 
 if __name__ == '__main__':
     unittest.main()
-    DB.writer_running.clear()
+    DB.stop_writer()
@@ -11,6 +11,10 @@ from apocrypha.datum import Datum
 
 from test_server import TestServerBase, PORT
 
+# run the shared server for this module's tests too
+# pylint: disable=unused-import
+from test_server import setUpModule, tearDownModule  # noqa: F401
+
 
 def datum():
     return Datum(port=PORT)
@@ -21,109 +25,122 @@ class TestDatum(TestServerBase):
     def test_init(self):
         datum()
 
+    def test_shared_connection(self):
+        with datum() as d:
+            d['shared'] = 'connection'
+            child = d['shared']
+
+            self.assertIs(child._client, d._client)
+            self.assertEqual(str(child), 'connection')
+            self.assertIsNotNone(d._client.sock)
+
+        self.assertIsNone(d._client.sock)
+
+        # reconnects when used again
+        self.assertEqual(str(d['shared']), 'connection')
+
     def test_set_get(self):
-        d = datum()
-        d['apple'] = 'sauce'
+        with datum() as d:
+            d['apple'] = 'sauce'
 
-        self.assertEqual(
-            str(d['apple']), 'sauce')
+            self.assertEqual(
+                str(d['apple']), 'sauce')
 
     def test_delete(self):
-        d = datum()
-
-        d['test_delete'] = 'hello'
-        self.assertEqual(
-            str(d['test_delete']), 'hello')
+        with datum() as d:
+            d['test_delete'] = 'hello'
+            self.assertEqual(
+                str(d['test_delete']), 'hello')
 
-        del d['test_delete']
+            del d['test_delete']
 
-        self.assertEqual(
-            d['test_delete'], {})
+            self.assertEqual(
+                d['test_delete'], {})
 
     def test_iterate(self):
-        d = datum()
+        with datum() as d:
+            in_nums = list(range(0, 10))
+            d['numbers'] = in_nums
 
-        in_nums = list(range(0, 10))
-        d['numbers'] = in_nums
+            self.assertListEqual(
+                list(d['numbers']), in_nums)
+            self.assertListEqual(
+                d['numbers'].to_list(), in_nums)
 
-        nums = []
-        for i in d['numbers']:
-            nums += [i]
-
-        self.assertListEqual(
-            nums, in_nums)
+    def test_to_list(self):
+        with datum() as d:
+            d['to list'] = 'single'
+            self.assertListEqual(d['to list'].to_list(), ['single'])
+            self.assertListEqual(d['not there'].to_list(), [])
 
     def test_length_str(self):
-        d = datum()
-        d['string'] = 'hey' * 10
+        with datum() as d:
+            d['string'] = 'hey' * 10
 
-        self.assertEqual(
-            len(d['string']),
-            30)
+            self.assertEqual(
+                len(d['string']),
+                30)
 
     def test_length_dict(self):
-        d = datum()
-        d['dict'] = {1: 2, 3: 4}
-        self.assertEqual(
-            len(d['dict']), 2)
+        with datum() as d:
+            d['dict'] = {1: 2, 3: 4}
+            self.assertEqual(
+                len(d['dict']), 2)
 
     def test_add_to_nothing(self):
-        d = datum()
-        d['adding'] += 'hello'
+        with datum() as d:
+            d['adding'] += 'hello'
 
-        self.assertEqual(
-            str(d['adding']), 'hello')
+            self.assertEqual(
+                str(d['adding']), 'hello')
 
     def test_add_to_existing(self):
-        d = datum()
-        d['adding again'] += 'hello'
-        d['adding again'] += 'hello'
+        with datum() as d:
+            d['adding again'] += 'hello'
+            d['adding again'] += 'hello'
 
-        self.assertEqual(
-            list(d['adding again']), ['hello', 'hello'])
+            self.assertEqual(
+                list(d['adding again']), ['hello', 'hello'])
 
     @unittest.expectedFailure
     def test_keys_integers(self):
-        d = datum()
-        data = {1: 2, 3: 4, 5: 6}
+        with datum() as d:
+            data = {1: 2, 3: 4, 5: 6}
 
-        d['dict'] = data
+            d['dict'] = data
 
-        out = []
-        for i in d['dict'].keys():
-            out += [i]
+            out = []
+            for i in d['dict'].keys():
+                out += [i]
 
-        self.assertEqual(
-            list(data.keys()), out)
+            self.assertEqual(
+                list(data.keys()), out)
 
     def test_keys_strings(self):
-        d = datum()
-        data = {'1': 2, '3': 4, '5': 6}
+        with datum() as d:
+            data = {'1': 2, '3': 4, '5': 6}
 
-        d['dict'] = data
+            d['dict'] = data
 
-        out = []
-        for i in d['dict'].keys():
-            out += [i]
+            out = list(d['dict'].keys())
 
-        self.assertListEqual(
-            sorted(list(data.keys())), sorted(out))
+            self.assertListEqual(
+                sorted(list(data.keys())), sorted(out))
 
     def test_append(self):
-        d = Datum('appending', port=PORT)
-        d.append('a')
-        d.append('b')
+        with Datum('appending', port=PORT) as d:
+            d.append('a')
+            d.append('b')
 
-        self.assertListEqual(
-            list(d), ['a', 'b'])
+            self.assertListEqual(
+                list(d), ['a', 'b'])
 
     def test_pop(self):
-        d = Datum('popping', port=PORT)
-        d.append('a')
-        result = d.pop()
-
-        self.assertEqual(result, 'a')
+        with Datum('popping', port=PORT) as d:
+            d.append('a')
+            result = d.pop()
 
+            self.assertEqual(result, 'a')
 
 
 if __name__ == '__main__':
@@ -5,15 +5,20 @@
 # pylint: disable=missing-docstring
 # pylint: disable=too-many-public-methods
 
+import selectors
 import socket
+import struct
 import unittest
 import time
 import threading
 import warnings
+from unittest import mock
 
-from apocrypha.network import write, read
+from apocrypha.network import \
+    configure, encode, write, write_many, read, read_args, SCATTER_THRESHOLD
 
 address = ('localhost', 12345)
+large_message = 'hello' * 1000
 running = threading.Event()
 running.set()
 
@@ -22,56 +27,55 @@ class echo_server():
 
     def __init__(self):
         self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.serversocket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.serversocket.bind(address)
         self.serversocket.listen(5)
         self.serversocket.setblocking(0)
         self.connection = None
 
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.serversocket, selectors.EVENT_READ)
+
     def run(self):
 
         while running.is_set():
-            try:
+            for _ in self.sel.select(timeout=0.1):
                 self.connection, _ = self.serversocket.accept()
+                self.connection.setblocking(True)
                 message = self.connection.recv(1024)
                 self.connection.send(message)
-
-            except BlockingIOError:
-                pass
-
-            finally:
-                time.sleep(0.1)
+                self.connection.close()
 
     def stop(self):
+        self.sel.close()
         self.serversocket.close()
         if self.connection:
             self.connection.close()
 
 
-class TestNetwork(unittest.TestCase):
-
-    @classmethod
-    def setUpClass(cls):
-
-        warnings.simplefilter("ignore", ResourceWarning)
-        TestNetwork.server = echo_server()
-
-        TestNetwork.thread = threading.Thread(target=TestNetwork.server.run)
-        TestNetwork.thread.start()
+def echo(sock):
+    ''' echo one message back like echo_server, then hang up
+    '''
+    message = sock.recv(1024)
+    if message:
+        sock.sendall(message)
+    sock.close()
 
-    @classmethod
-    def tearDownClass(cls):
 
-        running.clear()
-        TestNetwork.server.stop()
-        TestNetwork.thread.join()
+class TestNetwork(unittest.TestCase):
+    ''' the protocol itself, over a socketpair so the TCP stack isn't
+    involved
+    '''
 
     def setUp(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect(address)
+        self.sock, peer = socket.socketpair()
+        self.echo_thread = threading.Thread(target=echo, args=(peer,))
+        self.echo_thread.start()
 
     def tearDown(self):
-        if self.sock:
-            self.sock.close()
+        self.sock.close()
+        self.echo_thread.join()
 
     def test_read_write(self):
 
@@ -93,16 +97,127 @@ class TestNetwork(unittest.TestCase):
         self.assertFalse(error)
         self.assertEqual(msg, result)
 
-    def test_write_error(self):
-        self.sock.close()
-        error = write(self.sock, 'hello')
-        self.assertTrue(error)
+    def test_read_write_bytes(self):
 
-    def test_read_error_general(self):
+        msg = encode(['apple', 'sauce'])
+        self.assertEqual(msg, b'apple\nsauce\n')
+
+        error = write(self.sock, msg)
+        self.assertFalse(error)
+
+        result, error = read(self.sock)
+        self.assertFalse(error)
+        self.assertEqual(msg.decode(), result)
+
+    def test_read_args(self):
+
+        error = write(self.sock, 'apple\n\nsauce\n')
+        self.assertFalse(error)
+
+        result, error = read_args(self.sock)
+        self.assertFalse(error)
+        self.assertEqual(result, ['apple', 'sauce'])
+
+    def test_read_buffer(self):
+
+        buffer = bytearray(4)
+        sender, receiver = socket.socketpair()
+
+        for msg in ['a', '', 'hello there apple sauce']:
+            self.assertFalse(write(sender, msg))
+            self.assertEqual(read(receiver, buffer), (msg, False))
+
+        # larger messages don't grow the buffer that's kept
+        self.assertEqual(len(buffer), 4)
+
+        self.assertFalse(write(sender, encode(['apple', 'sauce'])))
+        self.assertEqual(
+            read_args(receiver, buffer), (['apple', 'sauce'], False))
+
+        sender.close()
+        self.assertEqual(read(receiver, buffer), ('', True))
+        receiver.close()
+
+    def test_write_single_send(self):
+        ''' the header and message go out together in one call
+        '''
+        sock = mock.Mock(spec=socket.socket)
+        self.assertFalse(write(sock, large_message))
+
+        sock.sendall.assert_called_once_with(
+            struct.pack('>I', len(large_message)) + large_message.encode())
+
+    def test_write_many(self):
+        sender, receiver = socket.socketpair()
+        messages = [b'apple\n', b'', large_message.encode()]
+
+        self.assertFalse(write_many(sender, messages))
+        for message in messages:
+            self.assertEqual(read(receiver), (message.decode(), False))
+
+        sender.close()
+        self.assertTrue(write_many(sender, messages))
+        receiver.close()
+
+    def test_read_fragments(self):
+        ''' a message that arrives in pieces is put back together
+        '''
+        sender, receiver = socket.socketpair()
+        message = large_message.encode()
+        data = struct.pack('>I', len(message)) + message
+
+        def writer():
+            for i in range(0, len(data), 100):
+                sender.sendall(data[i:i + 100])
+                time.sleep(0.0001)
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+
+        self.assertEqual(read(receiver), (large_message, False))
+        writer_thread.join()
+
+        # closed part way through the header
+        sender.sendall(b'\x00\x00')
+        sender.close()
+        self.assertEqual(read(receiver), ('', True))
+        receiver.close()
+
+    def test_read_truncated(self):
+        ''' the connection closes before the whole message arrives
+        '''
+        sender, receiver = socket.socketpair()
+        sender.sendall(struct.pack('>I', 10) + b'hello')
+        sender.close()
+
+        self.assertEqual(read(receiver), ('', True))
+        receiver.close()
+
+    def test_read_args_error(self):
         self.sock.close()
 
-        _, error = read(self.sock)
+        result, error = read_args(self.sock)
         self.assertTrue(error)
+        self.assertEqual(result, [])
+
+    def test_read_write_scatter(self):
+        ''' large messages are sent with sendmsg, which may take several calls
+        to drain through the socket buffer
+        '''
+        msg = 'a' * (SCATTER_THRESHOLD * 8)
+        left, right = socket.socketpair()
+
+        def writer():
+            self.assertFalse(write(left, msg))
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+
+        result, error = read(right)
+        writer_thread.join()
+        left.close()
+        right.close()
+
+        self.assertFalse(error)
+        self.assertEqual(msg, result)
 
     def test_read_error_size(self):
         ''' introduce a failure while reading the body after the message side
@@ -114,7 +229,7 @@ class TestNetwork(unittest.TestCase):
             self.sock.close()
         failure_thread = threading.Thread(target=failure)
 
-        msg = 'hello' * 1000
+        msg = large_message
         failure_thread.start()
         write(self.sock, msg)
 
@@ -123,5 +238,66 @@ class TestNetwork(unittest.TestCase):
         self.assertTrue(error)
 
 
+class TestNetworkTCP(unittest.TestCase):
+    ''' behaviour that depends on real TCP connections
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+
+        warnings.simplefilter("ignore", ResourceWarning)
+        TestNetworkTCP.server = echo_server()
+
+        TestNetworkTCP.thread = threading.Thread(
+            target=TestNetworkTCP.server.run)
+        TestNetworkTCP.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+
+        running.clear()
+        TestNetworkTCP.server.stop()
+        TestNetworkTCP.thread.join()
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect(address)
+
+    def tearDown(self):
+        if self.sock:
+            self.sock.close()
+
+    def test_read_write(self):
+
+        msg = 'hello there apple sauce'
+        error = write(self.sock, msg)
+        self.assertFalse(error)
+
+        result, error = read(self.sock)
+        self.assertFalse(error)
+        self.assertEqual(msg, result)
+
+    def test_configure(self):
+
+        configure(self.sock)
+        self.assertTrue(
+            self.sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+
+        msg = 'configured'
+        self.assertFalse(write(self.sock, msg))
+        self.assertEqual(read(self.sock), (msg, False))
+
+    def test_write_error(self):
+        self.sock.close()
+        error = write(self.sock, 'hello')
+        self.assertTrue(error)
+
+    def test_read_error_general(self):
+        self.sock.close()
+
+        _, error = read(self.sock)
+        self.assertTrue(error)
+
+
 if __name__ == '__main__':
     unittest.main()
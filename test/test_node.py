@@ -6,16 +6,21 @@
 # pylint: disable=missing-docstring
 # pylint: disable=too-many-public-methods
 
+import copy
+import json
 import random
 import time
 import threading
 import unittest
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import apocrypha.client
+import apocrypha.database
 import apocrypha.exceptions
+import apocrypha.serialize
 from apocrypha.server import ServerDatabase
-from apocrypha.node import NodeHandler, Node
+from apocrypha.node import NodeHandler, Node, Peer
 
 alpha_port = 4999
 beta_port = 5999
@@ -25,67 +30,206 @@ alpha_client = apocrypha.client.Client(port=alpha_port)
 beta_client = apocrypha.client.Client(port=beta_port)
 omega_client = apocrypha.client.Client(port=omega_port)
 
+# client methods used by random queries, and the operators they send
+queries_without_args = {
+    'pop': '--pop',
+    'delete': '--del',
+    'keys': '--keys',
+    'get': '--edit',
+}
+queries_with_args = {
+    'set': '--set',
+    'append': '+',
+    'remove': '-',
+}
+
+_OPTIONS = tuple(queries_with_args) + tuple(queries_without_args)
+_TARGETS = ('one', 'two', 'three', 'four', 'five')
+_VALUE_POOL = tuple(str(i) for i in range(10001))
+_SHAPES = (
+    lambda value: value,
+    lambda value: [value, value, value],
+    lambda value: {value: value},
+)
+_rand = random.Random()
+
+# every node starts from the same data, only read it once
+_TEST_DB_DATA = apocrypha.database._load('test/test-db.json')
+
+
+def random_query_specs(count, rand=_rand):
+    ''' int, maybe random.Random -> list of (str, list of str, any)
+
+    choose random client methods, targets and values without running them.
+    each decision is drawn for the whole batch at once
+    '''
+    choices = rand.choices(_OPTIONS, k=count)
+    firsts = rand.choices(_TARGETS, k=count)
+    seconds = rand.choices(_TARGETS, k=count)
+    depths = rand.choices((1, 2), k=count)
+    values = rand.choices(_VALUE_POOL, k=count)
+    shapes = rand.choices(_SHAPES, k=count)
+
+    return [
+        (choice,
+         [first] if depth == 1 else [first, second],
+         None if choice in queries_without_args else shape(value))
+        for choice, first, second, depth, value, shape
+        in zip(choices, firsts, seconds, depths, values, shapes)]
+
+
+def random_query_spec(rand=_rand):
+    ''' maybe random.Random -> str, list of str, any
+
+    choose a random client method, target and value without running it
+    '''
+    return random_query_specs(1, rand)[0]
+
+
+def spec_to_query(spec):
+    ''' str, list of str, any -> list of str | none
+
+    the arguments the client would send for this spec, none if the client
+    would reject it without sending anything
+    '''
+    choice, target, value = spec
+
+    if choice in queries_without_args:
+        return target + [queries_without_args[choice]]
+
+    if choice == 'set':
+        return target + ['--set', json.dumps(value)]
+
+    if isinstance(value, dict):
+        return None
+
+    if isinstance(value, str):
+        value = [value]
+
+    return target + [queries_with_args[choice]] + value
+
+
+def make_random_query(client, debug=False, rand=_rand):
+    ''' Client, maybe bool, maybe random.Random -> (none -> none)
+
+    a function that runs one random query with the client each time it's
+    called. the client's methods are looked up once here, not on every call
+    '''
+    methods = {choice: getattr(client, choice) for choice in _OPTIONS}
+
+    def run():
+        choice, target, value = random_query_spec(rand)
+        method = methods[choice]
+
+        try:
+            if value is None:
+                if debug:
+                    print(choice, target)
+                method(*target)
+            else:
+                if debug:
+                    print(choice, target, value)
+                method(*target, value=value)
+        except apocrypha.exceptions.DatabaseError:
+            # we did something invalid, but it was reported correctly
+            pass
+
+    return run
+
 
 def random_query(client, debug=False):
+    make_random_query(client, debug)()
 
-    queries_without_args = [
-        client.pop,
-        client.delete,
-        client.keys,
-        client.get
-    ]
-    queries_with_args = [
-        client.set,
-        client.append,
-        client.remove
-    ]
-
-    options = queries_with_args + queries_without_args
-    choice = random.choice(options)
-
-    targets = ['one', 'two', 'three', 'four', 'five']
-    target = [random.choice(targets)]
-    target = random.choice([
-        target,
-        target + [random.choice(targets)]
-    ])
-
-    value = str(random.randint(0, 10000))
-    value = random.choice([
-        value,
-        [value, value, value],
-        {value: value, value: value}
-    ])
 
-    try:
-        if choice in queries_without_args:
-            if debug:
-                print(choice.__name__, target)
-            choice(*target)
-        else:
-            if debug:
-                print(choice.__name__, target, value)
-            choice(*target, value=value)
-    except apocrypha.exceptions.DatabaseError:
-        # we did something invalid, but it was reported correctly
-        pass
+def grab_all_raw(client):
+    ''' Client -> dict of str
+
+    every top level key except for 'internal', with it's value as the server
+    sends it. --edit sorts keys, so equal values always have equal replies
+
+    the keys are fetched together in one pipelined batch, so the peer
+    information under 'internal' is never sent
+    '''
+    keys = [key for key in client.keys() if key != 'internal']
+    replies = client.query_many([[key, '--edit'] for key in keys])
+
+    return dict(zip(keys, replies))
+
+
+def synchronized(*clients):
+    ''' Client ... -> bool
+
+    whether all the nodes have the same data, compared as the server sends it
+    '''
+    expected, *results = map(grab_all_raw, clients)
+    return all(result == expected for result in results)
 
 
 def grab_all(client):
     ''' retreive everything except for 'internal' key
     '''
-    result = client.get()
-    del result['internal']
-    return result
+    return {
+        key: apocrypha.serialize.loads(reply)
+        for key, reply in grab_all_raw(client).items()}
 
 
 def verify_peers(client, ports):
-    ''' list of int -> bool
+    ''' Client, list of int -> (none -> bool)
+
+    a predicate for wait_until that checks the client's node has exactly these
+    peers. the expected set is only built once, not every time it's polled.
+    the lengths are compared too, so a port listed twice isn't hidden
+    '''
+    expected = frozenset(ports)
+
+    def verify():
+        result = client.get('internal', 'peers', default={})
+        return len(result) == len(expected) and \
+            frozenset(peer['port'] for peer in result.values()) == expected
+
+    return verify
+
+
+# seconds to wait for the nodes to find each other, several times longer than
+# it normally takes
+PROPAGATION_TIMEOUT = 30
+
+
+def wait_until(predicate, timeout=10, interval=0.01):
+    ''' (none -> bool), number, number -> bool
+
+    poll until the predicate is true, giving up after timeout seconds
+    '''
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+
+    return predicate()
+
+
+def responds(client):
+    ''' Client -> bool
     '''
-    result = client.get('internal', 'peers')
+    try:
+        client.keys('internal')
+    except (ConnectionError, apocrypha.exceptions.DatabaseError):
+        return False
+    return True
+
+
+def make_database():
+    ''' none -> ServerDatabase
 
-    result_ports = [result[peer]['port'] for peer in result]
-    return sorted(result_ports) == sorted(ports)
+    a stateless database with a private copy of the test data, which is only
+    read from disk once
+    '''
+    return ServerDatabase(
+        'test/test-db.json',
+        stateless=True,
+        initial_data=copy.deepcopy(_TEST_DB_DATA))
 
 
 def make_node(external_port):
@@ -94,9 +238,7 @@ def make_node(external_port):
     node_address = ('localhost', external_port)
     server_address = ('localhost', internal_port)
 
-    database = ServerDatabase(
-        'test/test-db.json',
-        stateless=True)
+    database = make_database()
 
     node = Node(
         node_address,
@@ -114,14 +256,6 @@ def make_node(external_port):
     return node, node_thread
 
 
-def ignore_warnings(test_func):
-    def do_test(self, *args, **kwargs):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", ResourceWarning)
-            test_func(self, *args, **kwargs)
-    return do_test
-
-
 class TestNode(unittest.TestCase):
 
     @classmethod
@@ -130,44 +264,76 @@ class TestNode(unittest.TestCase):
         create an Apocrypha instance and server to handle connections
         run the server in a thread so test cases may run
         '''
-        TestNode.alpha_node, TestNode.alpha_node_thread = \
-            make_node(alpha_port)
+        # set once for the whole class, the test runner installs it's own
+        # filters before running, so this can't be done at import time
+        warnings.simplefilter("ignore", ResourceWarning)
 
-        TestNode.beta_node, TestNode.beta_node_thread = \
-            make_node(beta_port)
+        # the nodes don't depend on each other, so start them all at once
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [
+                executor.submit(make_node, port)
+                for port in (alpha_port, beta_port, omega_port)]
 
-        TestNode.omega_node, TestNode.omega_node_thread = \
-            make_node(omega_port)
+            (TestNode.alpha_node, TestNode.alpha_node_thread), \
+                (TestNode.beta_node, TestNode.beta_node_thread), \
+                (TestNode.omega_node, TestNode.omega_node_thread) = \
+                [future.result() for future in futures]
 
-        # give the nodes time to get set up
-        time.sleep(5)
+        # wait for the nodes to get set up
+        wait_until(lambda: all(
+            responds(client)
+            for client in [alpha_client, beta_client, omega_client]))
 
     @classmethod
     def tearDownClass(cls):
         '''
         shutdown the server
         '''
-        warnings.simplefilter("ignore", ResourceWarning)
-
         print('\ntearing down, may take up to 5 seconds')
         for client in [alpha_client, beta_client, omega_client]:
-            client.sock.close()
+            client.close()
 
         nodes = [
             TestNode.alpha_node,
             TestNode.beta_node,
             TestNode.omega_node
         ]
-        for node in nodes:
-            node.teardown()
-
         threads = [
             TestNode.alpha_node_thread,
             TestNode.beta_node_thread,
             TestNode.omega_node_thread
         ]
-        for thread in threads:
-            thread.join(1)
+
+        # each teardown waits for it's node to stop, so wait for them together
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda node: node.teardown(), nodes))
+            list(executor.map(lambda thread: thread.join(1), threads))
+
+    def assert_synchronized(self, *clients):
+        ''' compare the serialized data first, it only needs to be parsed to
+        describe a difference
+        '''
+        if synchronized(*clients):
+            return
+
+        expected, *results = map(grab_all, clients)
+        for result in results:
+            self.assertEqual(expected, result)
+
+    def assert_propagates(self, predicate, start):
+        ''' wait for the predicate, then report how long it took since start
+
+        peers are only connected to and checked once per tick, so this takes a
+        few ticks. the timeout is there to catch propagation that never
+        happens, not to measure how fast it is
+        '''
+        self.assertTrue(
+            wait_until(predicate, timeout=PROPAGATION_TIMEOUT),
+            'no propagation after {t}s'.format(t=PROPAGATION_TIMEOUT))
+
+        elapsed = time.monotonic() - start
+        print('propagation took {e:.3f}s, {t:.1f} ticks'.format(
+            e=elapsed, t=elapsed / Node.tick))
 
     def test_1_alpha_sanity(self):
         alpha_client.set('apple', value='sauce')
@@ -184,7 +350,6 @@ class TestNode(unittest.TestCase):
         result = omega_client.get('apple')
         self.assertEqual(result, 'sauce')
 
-    @ignore_warnings
     def test_4_connect_beta(self):
         ''' alpha --connect -> beta
 
@@ -195,24 +360,22 @@ class TestNode(unittest.TestCase):
         '''
         # send the connect query
         alpha_client.query(['--connect', 'localhost', str(beta_port)])
+        start = time.monotonic()
 
-        # give alpha time to react and update it's peer information with beta's
+        # wait for alpha to react and update it's peer information with beta's
         # information
-        time.sleep(5)
-
-        result = alpha_client.get('internal', 'peers')
-        self.assertTrue(verify_peers(alpha_client, [beta_port]))
+        self.assert_propagates(
+            verify_peers(alpha_client, [beta_port]), start)
 
-        # give beta time to connect back to alpha
-        time.sleep(5)
+        # wait for beta to connect back to alpha
+        self.assert_propagates(
+            verify_peers(beta_client, [alpha_port]), start)
 
         result = beta_client.get('internal', 'peers')
-        alpha = list(result.keys())[0]
+        alpha, = result.values()
 
-        peer_port = result[alpha]['port']
-        self.assertEqual(peer_port, alpha_port)
+        self.assertEqual(alpha['port'], alpha_port)
 
-    @ignore_warnings
     def test_5_connect_omega(self):
         ''' alpha --connect omega
 
@@ -223,37 +386,40 @@ class TestNode(unittest.TestCase):
         '''
         # send the alpha -> omega connect query
         alpha_client.query(['--connect', 'localhost', str(omega_port)])
+        start = time.monotonic()
 
-        # give alpha time to react and update it's peer information with
-        # omega's information
-        time.sleep(5)
+        # wait for alpha to react and update it's peer information with
+        # omega's information. make sure that beta and omega are in alpha's
+        # peers
+        self.assert_propagates(
+            verify_peers(alpha_client, [beta_port, omega_port]), start)
 
-        # make sure that beta and omega are in alpha's peers
-        self.assertTrue(
-            verify_peers(alpha_client, [beta_port, omega_port]))
+        # wait for omega to connect back to alpha, and beta, and for beta to
+        # connect to omega
+        self.assert_propagates(
+            verify_peers(omega_client, [beta_port, alpha_port]), start)
 
-        # give omega time to connect back to alpha, and beta
-        # beta time to connect to omega
-        time.sleep(5)
-        self.assertTrue(
-            verify_peers(omega_client, [beta_port, alpha_port]))
-
-        self.assertTrue(
-            verify_peers(beta_client, [alpha_port, omega_port]))
+        self.assert_propagates(
+            verify_peers(beta_client, [alpha_port, omega_port]), start)
 
     def test_rejoin(self):
         ''' omega drops out, everyone automatically reconnects when it comes
         back up
         '''
         global omega_client
-        warnings.simplefilter("ignore", ResourceWarning)
 
         # shutdown omega
         TestNode.omega_node.teardown()
         TestNode.omega_node_thread.join(1)
 
         # wait for alpha and beta to figure it out
-        time.sleep(5)
+        def omega_dropped():
+            return all(
+                peer.port != omega_port
+                for node in [TestNode.alpha_node, TestNode.beta_node]
+                for peer in list(node.peers.values()))
+
+        self.assertTrue(wait_until(omega_dropped))
 
         # make sure omega is dead
         with self.assertRaises(apocrypha.exceptions.DatabaseError):
@@ -265,31 +431,29 @@ class TestNode(unittest.TestCase):
         a = alpha_client.get('green')
         self.assertTrue(a == 'berry', a)
 
-        time.sleep(2)
-        b = beta_client.get('green')
-        self.assertTrue(b == 'berry', b)
+        self.assertTrue(
+            wait_until(lambda: beta_client.get('green') == 'berry'))
 
         # bring omega back
         TestNode.omega_node, TestNode.omega_node_thread = \
             make_node(omega_port)
 
         # wait for everyone to rejoin
-        time.sleep(4)
-
-        # send a message to omega
         omega_client = apocrypha.client.Client(port=omega_port)
+        self.assertTrue(wait_until(
+            verify_peers(omega_client, [alpha_port, beta_port])))
 
+        # send a message to omega
         omega_client.set('yellow', value='berry')
         a = omega_client.get('yellow')
 
-        # check it on the others
-        time.sleep(2)
-        b = beta_client.get('yellow')
-        o = alpha_client.get('yellow')
-
         self.assertTrue(a == 'berry', a)
-        self.assertTrue(b == 'berry', b)
-        self.assertTrue(o == 'berry', o)
+
+        # check it on the others
+        self.assertTrue(
+            wait_until(lambda: beta_client.get('yellow') == 'berry'))
+        self.assertTrue(
+            wait_until(lambda: alpha_client.get('yellow') == 'berry'))
 
     def test_5_write_query(self):
         ''' send a write query to alpha, make sure everyone in the mesh
@@ -298,31 +462,26 @@ class TestNode(unittest.TestCase):
         alpha_client.set('blue', value='berry')
         a = alpha_client.get('blue')
 
-        time.sleep(2)
-        b = beta_client.get('blue')
-        o = omega_client.get('blue')
-
         self.assertTrue(a == 'berry', a)
-        self.assertTrue(b == 'berry', b)
-        self.assertTrue(o == 'berry', o)
+
+        self.assertTrue(
+            wait_until(lambda: beta_client.get('blue') == 'berry'))
+        self.assertTrue(
+            wait_until(lambda: omega_client.get('blue') == 'berry'))
 
     def test_6_sychronize_one_direction(self):
         ''' send a bunch of messages to one node, make sure everyone is
         eventually consistent '''
 
-        for _ in range(0, 400):
-            random_query(alpha_client)
-
-        # give nodes time to synchronize
-        time.sleep(5)
+        specs = random_query_specs(400)
+        alpha_client.query_many(
+            [query for query in map(spec_to_query, specs) if query])
 
-        a = grab_all(alpha_client)
-        b = grab_all(beta_client)
-        o = grab_all(omega_client)
+        # wait for the nodes to synchronize
+        wait_until(lambda: synchronized(
+            alpha_client, beta_client, omega_client))
 
-        self.assertEqual(a, b)
-        self.assertEqual(b, o)
-        self.assertEqual(a, o)
+        self.assert_synchronized(alpha_client, beta_client, omega_client)
 
     def test_7_sychronize_one_direction_threads(self):
         ''' send a bunch of messages to one node using multiple threads,
@@ -332,15 +491,22 @@ class TestNode(unittest.TestCase):
         num_requests = 100
         num_workers = 5
 
-        def worker():
-            time.sleep(0.1)
-            for _ in range(0, num_requests):
-                random_query(alpha_client)
+        def script(seed):
+            # each worker has it's own generator and a fixed seed, so the
+            # queries are the same every run
+            rand = random.Random(seed)
+            specs = random_query_specs(num_requests, rand)
+            return [query for query in map(spec_to_query, specs) if query]
+
+        def worker(queries):
+            client = apocrypha.client.Client(port=alpha_port)
+            client.query_many(queries)
+            client.close()
 
         threads = []
-        for _ in range(0, num_workers):
+        for seed in range(0, num_workers):
             threads += [
-                threading.Thread(target=worker)
+                threading.Thread(target=worker, args=(script(seed),))
             ]
 
         for thread in threads:
@@ -349,16 +515,11 @@ class TestNode(unittest.TestCase):
         for thread in threads:
             thread.join()
 
-        # give nodes time to synchronize
-        time.sleep(5)
-
-        a = grab_all(alpha_client)
-        b = grab_all(beta_client)
-        o = grab_all(omega_client)
+        # wait for the nodes to synchronize
+        wait_until(lambda: synchronized(
+            alpha_client, beta_client, omega_client))
 
-        self.assertEqual(a, b)
-        self.assertEqual(b, o)
-        self.assertEqual(a, o)
+        self.assert_synchronized(alpha_client, beta_client, omega_client)
 
     @unittest.skip('not implemented')
     def test_8_sychronize_two_directions(self):
@@ -367,20 +528,30 @@ class TestNode(unittest.TestCase):
 
         self.maxDiff = None
 
+        alpha_query = make_random_query(alpha_client)
+        beta_query = make_random_query(beta_client)
+
         for _ in range(0, 50):
-            random_query(alpha_client)
-            random_query(beta_client)
+            alpha_query()
+            beta_query()
+
+        # wait for the nodes to synchronize
+        wait_until(lambda: synchronized(
+            alpha_client, beta_client, omega_client))
+
+        self.assert_synchronized(alpha_client, beta_client, omega_client)
+
 
-        # give nodes time to synchronize
-        time.sleep(10)
+class TestPeer(unittest.TestCase):
 
-        a = grab_all(alpha_client)
-        b = grab_all(beta_client)
-        o = grab_all(omega_client)
+    def test_connect_failure_logged(self):
+        with self.assertLogs('apocrypha.node', level='DEBUG') as logs:
+            with self.assertRaises(apocrypha.exceptions.PeerCreateFailed):
+                Peer('abcdef', 'localhost', 1)
 
-        self.assertEqual(a, b)
-        self.assertEqual(b, o)
-        self.assertEqual(a, o)
+        self.assertEqual(logs.output, [
+            'DEBUG:apocrypha.node:abcd attempting to connect to localhost:1',
+            'DEBUG:apocrypha.node:abcd could not connect to localhost:1'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# pylint: disable=missing-docstring
+
+import json
+import unittest
+from unittest import mock
+
+import apocrypha.serialize as serialize
+
+values = [
+    {},
+    [],
+    'a b c d',
+    {'b': ['1', '2'], 'a': {'c': 'd'}, 'e': {}},
+    {'unicode': 'café ☃'},
+]
+
+
+class TestSerialize(unittest.TestCase):
+
+    def test_loads(self):
+        self.assertEqual(serialize.loads('{"a": ["b"]}'), {'a': ['b']})
+        self.assertEqual(serialize.loads(b'"b"'), 'b')
+        self.assertEqual(serialize.loads(memoryview(b'["c"]')), ['c'])
+
+        with mock.patch.object(serialize, 'orjson', None):
+            self.assertEqual(serialize.loads(memoryview(b'["c"]')), ['c'])
+
+    def test_loads_error(self):
+        with self.assertRaises(ValueError):
+            serialize.loads('{"a": ')
+
+    def test_dumps_pretty(self):
+        self.assertEqual(
+            serialize.dumps_pretty({'b': '2', 'a': '1'}),
+            '{\n  "a": "1",\n  "b": "2"\n}')
+
+    def test_dumps(self):
+        self.assertEqual(
+            serialize.dumps({'a': ['b', 'ø']}), '{"a":["b","ø"]}'.encode())
+
+    def test_large_integers(self):
+        value = {'a': 2 ** 70}
+        self.assertEqual(serialize.loads(serialize.dumps(value)), value)
+        self.assertEqual(
+            serialize.dumps_pretty(value),
+            '{\n  "a": ' + str(2 ** 70) + '\n}')
+
+    def test_non_finite(self):
+        ''' NaN and infinities are written the way json writes them, rather
+        than as null
+        '''
+        text = '[NaN, Infinity, -Infinity, null, {"a": [NaN]}]'
+        value = serialize.loads(text)
+
+        self.assertEqual(
+            serialize.dumps(value),
+            b'[NaN,Infinity,-Infinity,null,{"a":[NaN]}]')
+        self.assertEqual(
+            serialize.dumps_pretty(value), json.dumps(value, indent=2))
+        self.assertEqual(
+            serialize.dumps(serialize.loads(serialize.dumps(value))),
+            serialize.dumps(value))
+
+        with mock.patch.object(serialize, 'orjson', None):
+            self.assertEqual(
+                serialize.dumps(value),
+                b'[NaN,Infinity,-Infinity,null,{"a":[NaN]}]')
+
+    def test_fallback_matches(self):
+        ''' the output doesn't depend on whether orjson is installed
+        '''
+        expected = [serialize.dumps_pretty(value) for value in values]
+        compact = [serialize.dumps(value) for value in values]
+
+        with mock.patch.object(serialize, 'orjson', None):
+            self.assertEqual(
+                [serialize.dumps_pretty(value) for value in values],
+                expected)
+            self.assertEqual(
+                [serialize.dumps(value) for value in values], compact)
+
+            for value, dumped in zip(values, expected):
+                self.assertEqual(serialize.loads(dumped), value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,83 +5,169 @@
 # pylint: disable=missing-docstring
 # pylint: disable=too-many-public-methods
 
-import time
+import contextlib
+import gc
+import io
+import json
+import random
+import socket
+import struct
 import threading
 import unittest
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 import apocrypha.client
+import apocrypha.network
 from apocrypha.exceptions import DatabaseError
-from apocrypha.server import ServerDatabase, ServerHandler, Server
-from test_node import random_query
+from apocrypha.server import \
+    ServerHandler, Server, _parse_arguments
+from test_node import \
+    make_database, make_random_query, random_query_specs, spec_to_query
 
 PORT = 49999
 
 client = apocrypha.client.Client(port=PORT)
 
 
+def random_queries(count, rand=None):
+    ''' int, maybe random.Random -> list of list of str
+    '''
+    specs = random_query_specs(count, rand or random.Random())
+    return [args for args in map(spec_to_query, specs) if args]
+
+
+def with_checks(queries, name, every=10):
+    ''' list of list of str, str, maybe int -> list of list of str, dict
+
+    mix sets and gets of keys under name into the queries, along with the
+    replies they have to get back. junk queries may fail, these may not
+    '''
+    mixed = []
+    expected = {}
+
+    for i, args in enumerate(queries):
+        if i % every == 0:
+            value = str(i)
+            expected[len(mixed)] = ''
+            mixed.append([name, value, '--set', json.dumps(value)])
+            expected[len(mixed)] = value + '\n'
+            mixed.append([name, value])
+
+        mixed.append(args)
+
+    return mixed, expected
+
+
 def query(args, raw=False):
     ''' list of string -> string
     '''
     return client.query(args, interpret=raw)
 
 
+def setUpModule():
+    '''
+    create an Apocrypha instance and server to handle connections, run the
+    server in a thread so test cases may run. every class in the module shares
+    it, modules that import this also share it's setup with their tests
+    '''
+    # create the ServerDatabase instance, which inherits from Apocrypha
+    TestServerBase.database = make_database()
+
+    # Create the tcp server
+    host, port = '0.0.0.0', PORT
+    TestServerBase.server = Server(
+        (host, port), ServerHandler,
+        TestServerBase.database, quiet=True)
+
+    # start the server
+    TestServerBase.server_thread = threading.Thread(
+        target=TestServerBase.server.serve_forever)
+
+    TestServerBase.server_thread.start()
+    TestServerBase.db = apocrypha.client.Client(port=PORT)
+
+
+def tearDownModule():
+    '''
+    shutdown the server
+    '''
+    TestServerBase.server.teardown()
+    TestServerBase.server.socket.close()
+    TestServerBase.server_thread.join(1)
+
+    # another module may start a new server, don't keep talking to this one
+    client.close()
+    TestServerBase.db.close()
+
+
 class TestServerBase(unittest.TestCase):
+    ''' tests that talk to the server started by setUpModule
+    '''
 
     database = None
     server = None
     server_thread = None
+    db = None
 
-    @classmethod
-    def setUpClass(cls):
-        '''
-        create an Apocrypha instance and server to handle connections
-        run the server in a thread so test cases may run
-        '''
-        # create the ServerDatabase instance, which inherits from Apocrypha
-        TestServerBase.database = ServerDatabase(
-            'test/test-db.json',
-            stateless=True)
-
-        # Create the tcp server
-        host, port = '0.0.0.0', PORT
-        TestServerBase.server = Server(
-            (host, port), ServerHandler,
-            TestServerBase.database, quiet=True)
-
-        # start the server
-        TestServerBase.server_thread = threading.Thread(
-            target=TestServerBase.server.serve_forever)
-
-        TestServerBase.server_thread.start()
-        TestServerBase.db = apocrypha.client.Client(port=PORT)
-
-    @classmethod
-    def tearDownClass(cls):
-        '''
-        shutdown the server
-        '''
-        TestServerBase.server.teardown()
-        TestServerBase.server.socket.close()
-        TestServerBase.server_thread.join(1)
 
-class TestServer(TestServerBase):
+class TestServerCache(TestServerBase):
+    ''' caching, these look at and invalidate cached results
+    '''
 
-    # server tests
-    #   caching
     def test_cache_hit(self):
 
         # write operations don't update the cache
         query(['pizza', '=', 'sauce'])
-        self.assertNotIn(('pizza',), TestServer.database.cache)
+        self.assertNotIn(('pizza',), self.database.cache)
 
         # get operations do
         query(['pizza'])
 
-        self.assertIn(('pizza',), TestServer.database.cache)
+        self.assertIn(('pizza',), self.database.cache)
         result = query(['pizza'])
 
         self.assertEqual(result, ['sauce'])
-        self.assertIn(('pizza',), TestServer.database.cache)
+        self.assertIn(('pizza',), self.database.cache)
+
+    def test_cache_hit_empty(self):
+        ''' empty results are cached too, and served without a second lookup
+        '''
+        query(['cache', 'empty', '-d'])
+        self.assertEqual(query(['cache', 'empty']), [])
+        self.assertEqual(
+            self.database.cache[('cache', 'empty')], b'')
+
+        self.assertEqual(query(['cache', 'empty']), [])
+
+    def test_cache_unicode(self):
+        ''' cache keys are the decoded arguments, so clients that encode the
+        same query differently still share an entry
+        '''
+        query(['café', '=', '☃'])
+        self.assertEqual(query(['café']), ['☃'])
+        self.assertEqual(
+            self.database.cache[('café',)], '☃\n'.encode('utf-8'))
+
+        self.assertEqual(
+            self.db.query_raw(b'caf\xc3\xa9\n\n'), '☃\n')
+
+    def test_cache_search(self):
+        ''' search results are cached, and dropped by any write
+        '''
+        query(['pizza', '=', 'marinara'])
+        self.assertEqual(query(['@', 'marinara']), ['pizza = marinara'])
+        self.assertIn(('@', 'marinara'), self.database.cache)
+
+        query(['burger', '=', 'marinara'])
+        self.assertNotIn(('@', 'marinara'), self.database.cache)
+        self.assertEqual(
+            sorted(query(['@', 'marinara'])),
+            ['burger = marinara', 'pizza = marinara'])
+
+        query(['burger', '-d'])
+        query(['pizza', '-d'])
 
     def test_cache_deep_hit(self):
         query(['a', '-d'])
@@ -90,22 +176,20 @@ class TestServer(TestServerBase):
 
         self.assertIn(
             ('a', 'b', 'c', 'd', 'e'),
-            TestServer.database.cache)
+            self.database.cache)
 
-    @unittest.skip('using simple caching')
     def test_cache_invalidate(self):
         query(['pizza', '=', 'sauce'])
 
         query(['pizza'])
         query([])
-        self.assertIn(('pizza',), TestServer.database.cache)
-        self.assertIn((), TestServer.database.cache)
+        self.assertIn(('pizza',), self.database.cache)
+        self.assertIn((), self.database.cache)
 
         query(['pizza', '-d'])
-        self.assertNotIn(('pizza',), TestServer.database.cache)
-        self.assertNotIn((), TestServer.database.cache)
+        self.assertNotIn(('pizza',), self.database.cache)
+        self.assertNotIn((), self.database.cache)
 
-    @unittest.skip('using simple caching')
     def test_cache_invalidate_parent(self):
         '''
         changing a child key invalidates all of it's parents
@@ -113,20 +197,19 @@ class TestServer(TestServerBase):
         query(['one layer', 'two layer', '=', 'cake'])
 
         query(['one layer', 'two layer'])
-        self.assertIn(('one layer', 'two layer'), TestServer.database.cache)
+        self.assertIn(('one layer', 'two layer'), self.database.cache)
 
         query(['one layer'])
-        self.assertIn(('one layer',), TestServer.database.cache)
+        self.assertIn(('one layer',), self.database.cache)
 
         # both parent and child are in cache, now change the child and make
         # sure the parent is also invalidated
 
         query(['one layer', 'two layer', '=', 'goop'])
 
-        self.assertNotIn(('one layer', 'two layer'), TestServer.database.cache)
-        self.assertNotIn(('one layer',), TestServer.database.cache)
+        self.assertNotIn(('one layer', 'two layer'), self.database.cache)
+        self.assertNotIn(('one layer',), self.database.cache)
 
-    @unittest.skip('using simple caching')
     def test_cache_invalidate_child(self):
         '''
         changing a parent key invalidates all of it's direct children
@@ -134,18 +217,18 @@ class TestServer(TestServerBase):
         query(['one layer', 'two layer', '=', 'cake'])
 
         query(['one layer', 'two layer'])
-        self.assertIn(('one layer', 'two layer'), TestServer.database.cache)
+        self.assertIn(('one layer', 'two layer'), self.database.cache)
 
         query(['one layer'])
-        self.assertIn(('one layer',), TestServer.database.cache)
+        self.assertIn(('one layer',), self.database.cache)
 
         # both parent and child are in cache, now change the parent and make
         # sure the child is also invalidated
 
         query(['one layer', '-d'])
 
-        self.assertNotIn(('one layer', 'two layer'), TestServer.database.cache)
-        self.assertNotIn(('one layer',), TestServer.database.cache)
+        self.assertNotIn(('one layer', 'two layer'), self.database.cache)
+        self.assertNotIn(('one layer',), self.database.cache)
 
     @unittest.skip('unknown issue')
     def test_cache_doesnt_effect_sibling(self):
@@ -153,7 +236,7 @@ class TestServer(TestServerBase):
 
         client.set('one layer', 'two layer', value='cake')
         client.set('one layer', 'apple layer', value='sauce')
-        print(TestServer.database.data)
+        print(self.database.data)
 
         self.assertEqual(
             client.get('one layer', 'two layer'), 'cake')
@@ -163,33 +246,87 @@ class TestServer(TestServerBase):
             client.get('one layer'),
             {'two layer': 'cake', 'apple layer': 'sauce'})
 
-        print(TestServer.database.cache)
-        self.assertIn(('one layer',), TestServer.database.cache)
-        self.assertIn(('one layer', 'two layer',), TestServer.database.cache)
-        self.assertIn(('one layer', 'apple layer',), TestServer.database.cache)
+        print(self.database.cache)
+        self.assertIn(('one layer',), self.database.cache)
+        self.assertIn(('one layer', 'two layer',), self.database.cache)
+        self.assertIn(('one layer', 'apple layer',), self.database.cache)
+
+    def test_cache_invalidate_other_keys(self):
+        '''
+        writes leave results under other top level keys in the cache
+        '''
+        query(['pizza', '=', 'sauce'])
+        query(['octopus'])
+        query(['pizza'])
+
+        query(['pizza', '=', 'cheese'])
+        self.assertNotIn(('pizza',), self.database.cache)
+        self.assertIn(('octopus',), self.database.cache)
 
     def test_cache_top_level_read_operators(self):
         '''
         make sure --keys, --edit on root are invalidated correctly
         '''
-        pass
+        query(['pizza', '=', 'sauce'])
+        query(['--keys'])
+        query(['--edit'])
+        self.assertIn(('--keys',), self.database.cache)
+        self.assertIn(('--edit',), self.database.cache)
+
+        query(['pizza', '=', 'cheese'])
+        self.assertNotIn(('--keys',), self.database.cache)
+        self.assertNotIn(('--edit',), self.database.cache)
 
     def test_cache_top_level_write_operators(self):
         '''
         writing to root clears the entire cache
         '''
-        pass
+        query(['octopus'])
+        self.assertIn(('octopus',), self.database.cache)
+
+        root = query(['--edit'], raw=True)
+        query(['--set', json.dumps(root)])
+        self.assertEqual(query(['--edit'], raw=True), root)
+        self.assertNotIn(('octopus',), self.database.cache)
 
     def test_cache_write_ops_not_cached(self):
-        pass
+        writes = [
+            ['menu', '--set', '{"pizza": "sauce"}'],
+            ['menu', 'pizza', '=', 'sauce'],
+            ['menu', 'pizza', '+', 'cheese'],
+            ['menu', 'pizza', '-', 'cheese'],
+            ['menu', 'pizza', '--pop'],
+            ['menu', '--del'],
+        ]
+
+        for args in writes:
+            query(args)
+            self.assertNotIn(tuple(args), self.database.cache)
 
     def test_cache_read_ops_are_cached(self):
         query(['pizza', '=', 'sauce'])
         value = query(['pizza', '--edit'])
 
-        self.assertIn(('pizza', '--edit',), TestServer.database.cache)
+        self.assertIn(('pizza', '--edit',), self.database.cache)
         self.assertEqual(value, ['"sauce"'])
 
+    def test_strict_not_cached(self):
+        self.assertEqual(query(['zounds']), [])
+
+        with self.assertRaises(DatabaseError):
+            query(['-s', 'zounds'])
+
+    def test_context_not_cached(self):
+        query(['sub', 'apple', '=', 'pear'])
+        self.assertEqual(query(['sub', 'apple']), ['pear'])
+        self.assertEqual(query(['-c', 'sub', 'apple']), ['sub = pear'])
+
+
+class TestServer(TestServerBase):
+    ''' queries that don't depend on what's in the cache
+    '''
+
+    # server tests
     #  timing
     @unittest.skip('timing not currently supported')
     def test_timing(self):
@@ -391,6 +528,14 @@ class TestServer(TestServerBase):
             TestServer.db.get('test list'),
             ['hello', 'there'])
 
+    def test_set_round_trip(self):
+        value = {'ø': ['☃', 2 ** 70, 1.5, True, None], 1: 'integer key'}
+        TestServer.db.set('round trip', value=value)
+
+        self.assertEqual(
+            TestServer.db.get('round trip'),
+            {'ø': ['☃', 2 ** 70, 1.5, True, None], '1': 'integer key'})
+
     def test_set_error(self):
         with self.assertRaises(DatabaseError):
             TestServer.db.set('hello', value=set())
@@ -435,37 +580,295 @@ class TestServer(TestServerBase):
                 ['non', 'existant', '--keys'], port=PORT),
             [])
 
+    def test_query_raw(self):
+        TestServer.db.set('raw', value=['a', 'b'])
+        self.assertEqual(
+            TestServer.db.query_raw(b'raw\n'),
+            'a\nb\n')
+
+    def test_query_raw_error(self):
+        result = TestServer.db.query_raw(b'animals\noctopus\n')
+        self.assertTrue(result.startswith('error: '))
+
+    def test_query_many(self):
+        result = TestServer.db.query_many([
+            ['many', '--set', '["a", "b"]'],
+            ['many'],
+            ['many', '+', 'c'],
+            ['many', '--keys'],
+            ['many'],
+        ])
+        self.assertEqual(
+            result, ['', 'a\nb\n', '', result[3], 'a\nb\nc\n'])
+        self.assertTrue(result[3].startswith('error: '))
+
+        # the connection is still usable afterwards
+        self.assertEqual(TestServer.db.get('many'), ['a', 'b', 'c'])
+
+    def test_query_many_error_reconnects(self):
+        ''' a failed read drops the connection, the next call opens a new one
+        '''
+        many_client = apocrypha.client.Client(port=PORT)
+        many_client.query_many([['many error', '=', 'a']])
+
+        with mock.patch(
+                'apocrypha.client.read', return_value=(None, True)):
+            with self.assertRaises(DatabaseError):
+                many_client.query_many([['many error']])
+        self.assertIsNone(many_client.sock)
+
+        self.assertEqual(
+            many_client.query_many([['many error']]), ['a\n'])
+        many_client.close()
+
+    def test_query_many_write_error(self):
+        ''' a failed send is raised right away rather than as a read error
+        '''
+        many_client = apocrypha.client.Client(port=PORT)
+
+        with mock.patch(
+                'apocrypha.client.write_many', return_value=True):
+            with self.assertRaises(DatabaseError):
+                many_client.query_many([['many error']])
+        self.assertIsNone(many_client.sock)
+
+    def test_query_many_connect_error(self):
+        ''' the socket is closed when it can't connect
+        '''
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+
+            with self.assertRaises(ConnectionError):
+                apocrypha.client.Client(port=PORT + 3).query_many([['a']])
+            gc.collect()
+
+        self.assertEqual(
+            [w for w in caught if w.category is ResourceWarning], [])
+
+    def test_query_many_window(self):
+        queries = [['window', '+', str(i)] for i in range(100)]
+        queries += [['window']]
+
+        result = TestServer.db.query_many(queries, window=8)
+        self.assertEqual(len(result), 101)
+        self.assertEqual(
+            result[-1], ''.join(str(i) + '\n' for i in range(100)))
+
+    def test_bind_in_use(self):
+        ''' a failed bind raises the socket's error, not one from the pool
+        '''
+        with self.assertRaises(OSError):
+            Server(('0.0.0.0', PORT), ServerHandler, self.database)
+
+    def test_half_sent_message(self):
+        ''' a client that stops partway through a message is dropped, rather
+        than holding up the other clients on its worker
+        '''
+        with mock.patch.object(Server, 'pool_size', 1):
+            server = Server(
+                ('localhost', PORT + 2), ServerHandler, make_database(),
+                quiet=True)
+        server.client_timeout = 0.2
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join, 1)
+        self.addCleanup(server.teardown)
+
+        stalled = socket.create_connection(('localhost', PORT + 2))
+        self.addCleanup(stalled.close)
+        stalled.sendall(struct.pack('>I', 10) + b'abc')
+
+        waiting = socket.create_connection(('localhost', PORT + 2))
+        self.addCleanup(waiting.close)
+        waiting.settimeout(5)
+        apocrypha.network.write(waiting, 'green\n')
+
+        self.assertEqual(
+            apocrypha.network.read(waiting), ('nice\n', False))
+
+        stalled.settimeout(5)
+        self.assertEqual(stalled.recv(1), b'')
+
     def test_fuzz(self):
         ''' throw a ton of junk at the server and see if it crashes
         '''
-        for _ in range(0, 1000):
-            random_query(client, debug=False)
+        queries, expected = with_checks(random_queries(1000), 'fuzz')
+        replies = client.query_many(queries)
+        self.assertEqual({i: replies[i] for i in expected}, expected)
+
+        # the same through the client's methods, which encode the values and
+        # raise on errors
+        run = make_random_query(client)
+        for _ in range(0, 200):
+            run()
+
+        client.set('fuzz', 'method', value=['a', 'b'])
+        self.assertEqual(client.get('fuzz', 'method'), ['a', 'b'])
 
     def test_lock_stress(self):
         ''' make a ton of junk queries from several threads
 
-        not interested in what the queries do, just that they don't crash the
-        server
+        not interested in what the junk queries do, just that they don't crash
+        the server. the sets and gets mixed in between them have to succeed
         '''
         num_requests = 500
+        num_method_requests = 50
         num_workers = 10
+        start = threading.Barrier(num_workers)
+
+        def worker(number):
+            # random.Random() seeds itself from os.urandom, and each worker
+            # having it's own means they don't share any generator state
+            rand = random.Random()
+            name = 'stress {n}'.format(n=number)
+            queries, expected = with_checks(
+                random_queries(num_requests, rand), name)
+
+            # each worker has it's own connection, so the server sees them
+            # concurrently instead of queued on one client's lock
+            worker_client = apocrypha.client.Client(port=PORT)
+            start.wait()
+            replies = worker_client.query_many(queries)
+
+            run = make_random_query(worker_client, rand=rand)
+            for _ in range(0, num_method_requests):
+                run()
+
+            worker_client.set(name, 'method', value=str(number))
+            method_value = worker_client.get(name, 'method')
+            worker_client.close()
+
+            self.assertEqual({i: replies[i] for i in expected}, expected)
+            self.assertEqual(method_value, str(number))
+
+        # every worker needs a thread of it's own to get past the barrier.
+        # result() raises anything a worker raised
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(worker, number)
+                for number in range(num_workers)]
+            for future in futures:
+                future.result()
+
+
+class TestParseArguments(unittest.TestCase):
+
+    def test_no_flags(self):
+        args = ['apple', '-s']
+        self.assertEqual(_parse_arguments(args), (False, False, args))
+        self.assertEqual(_parse_arguments([]), (False, False, []))
+
+    def test_flags(self):
+        self.assertEqual(
+            _parse_arguments(['-c', 'apple']), (True, False, ['apple']))
+        self.assertEqual(
+            _parse_arguments(['--strict', 'apple']), (False, True, ['apple']))
+        self.assertEqual(
+            _parse_arguments(['-s', '--context', '-s', 'apple', '-c']),
+            (True, True, ['apple', '-c']))
+
+    def test_only_flags(self):
+        self.assertEqual(_parse_arguments(['-c', '-s']), (True, True, []))
+
+
+class TestServerDatabase(unittest.TestCase):
+
+    def test_action_cache_hit_untouched(self):
+        ''' cache hits report that the database wasn't touched, so the
+        handler can skip post_action
+        '''
+        db = make_database()
+
+        self.assertTrue(db.action(['apple']))
+        first = db.output
+        db.post_action()
+
+        self.assertFalse(db.action(['apple']))
+        self.assertEqual(db.output, first)
+        self.assertIsInstance(db.output, bytes)
+
+    def test_reset(self):
+        db = make_database()
+        db.strict = True
+        db.add_context = True
+
+        db.reset()
+        self.assertFalse(db.strict)
+        self.assertFalse(db.add_context)
+        self.assertEqual(db.output, [])
+
 
-        def worker():
-            time.sleep(0.1)
-            for _ in range(0, num_requests):
-                random_query(client, debug=False)
+class TestServerLog(unittest.TestCase):
 
-        threads = []
-        for _ in range(0, num_workers):
-            threads += [
-                threading.Thread(target=worker)
-            ]
+    def test_log_written_in_batches(self):
+        ''' log lines are queued and written by the log thread, anything still
+        queued is written out before teardown finishes
+        '''
+        output = io.StringIO()
 
-        for thread in threads:
+        with contextlib.redirect_stdout(output):
+            server = Server(
+                ('localhost', PORT + 1), ServerHandler,
+                make_database())
+            thread = threading.Thread(target=server.serve_forever)
             thread.start()
 
-        for thread in threads:
-            thread.join()
+            for i in range(0, 3):
+                server.log('abcd', 0.5, i, ['apple', str(i)])
+
+            server.teardown()
+            thread.join(1)
+
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            ["abcd 0.50000  {i} ['apple', '{i}']".format(i=i)
+             for i in range(0, 3)])
+
+    def test_log_dropped(self):
+        ''' log lines that don't fit in the queue are counted and reported
+        '''
+        with mock.patch('apocrypha.server.LOG_QUEUE_SIZE', 2):
+            server = Server(
+                ('localhost', PORT + 1), ServerHandler,
+                make_database(),
+                quiet=True)
+
+        for i in range(0, 5):
+            server.log('abcd', 0.5, i, ['apple'])
+
+        # run the writer here instead of in its thread
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            server._log_queue.get_nowait()
+            server._log_queue.put(None)
+            server._log_writer()
+
+        self.assertEqual(
+            output.getvalue().splitlines(),
+            ["abcd 0.50000  1 ['apple']", '3 log lines dropped'])
+        server.server_close()
+
+    def test_log_args_truncated(self):
+        ''' long arguments are abbreviated rather than written out in full
+        '''
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            server = Server(
+                ('localhost', PORT + 1), ServerHandler,
+                make_database())
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            server.log('abcd', 0.5, 0, ['--set', 'x' * 1000] + ['a'] * 100)
+
+            server.teardown()
+            thread.join(1)
+
+        line, = output.getvalue().splitlines()
+        self.assertTrue(line.startswith("abcd 0.50000  0 ['--set', 'xxx"))
+        self.assertLessEqual(len(line), 100)
 
 
 if __name__ == '__main__':